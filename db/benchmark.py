@@ -0,0 +1,149 @@
+"""
+Compares insert and query throughput of the results schema before and after partitioning matches.
+Both schemas are created in throwaway schemas of the database given by the POSTGRESQL_* variables, and dropped afterwards.
+
+    python db/benchmark.py --hashes 20000 --methods 4 --pairs 2000000
+"""
+import argparse
+import io
+import os
+import random
+import time
+import psycopg2
+
+BEFORE = """
+CREATE TABLE hashes (id SERIAL PRIMARY KEY, hash BYTEA NOT NULL, hash_bits SMALLINT NOT NULL, hashing_method_id INTEGER NOT NULL);
+CREATE TABLE matches (
+  id SERIAL PRIMARY KEY,
+  hamming_distance SMALLINT NOT NULL,
+  hash_id1 INTEGER NOT NULL REFERENCES hashes(id),
+  hash_id2 INTEGER NOT NULL REFERENCES hashes(id)
+);
+ALTER TABLE matches ADD CONSTRAINT unique_matches UNIQUE (hamming_distance, hash_id1, hash_id2);
+"""
+
+AFTER = """
+CREATE TABLE hashes (id SERIAL PRIMARY KEY, hash BYTEA NOT NULL, hash_bits SMALLINT NOT NULL, hashing_method_id INTEGER NOT NULL);
+CREATE INDEX hashes_method_id ON hashes (hashing_method_id, id) INCLUDE (hash, hash_bits);
+CREATE TABLE matches (
+  id BIGINT GENERATED ALWAYS AS IDENTITY,
+  hashing_method_id INTEGER NOT NULL,
+  hamming_distance SMALLINT NOT NULL,
+  hash_id1 INTEGER NOT NULL REFERENCES hashes(id),
+  hash_id2 INTEGER NOT NULL REFERENCES hashes(id),
+  CONSTRAINT unique_matches PRIMARY KEY (hashing_method_id, hash_id1, hash_id2)
+) PARTITION BY LIST (hashing_method_id);
+CREATE TABLE matches_default PARTITION OF matches DEFAULT;
+"""
+
+BATCH_SIZE = 100_000
+
+def connect():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRESQL_DB") or "p-hash",
+        user=os.getenv("POSTGRESQL_USER") or "user",
+        password=os.getenv("POSTGRESQL_PASSWORD") or "",
+        host=os.getenv("POSTGRESQL_HOST") or "localhost",
+        port=int(os.getenv("POSTGRESQL_PORT") or 5432),
+    )
+
+def load_hashes(cur, hashes:int, methods:int):
+    buffer = io.StringIO()
+    for i in range(hashes * methods):
+        buffer.write(f"\\\\x{random.getrandbits(64):016x}\t64\t{i % methods + 1}\n")
+    buffer.seek(0)
+    cur.copy_expert("COPY hashes (hash, hash_bits, hashing_method_id) FROM STDIN", buffer)
+    cur.execute("ANALYZE hashes")
+
+def read_hashes(cur, methods:int)->float:
+    """
+    Pages through the hashes of every method like Database.get_hashes. Returns hashes per second
+    """
+    start, total = time.perf_counter(), 0
+    for method_id in range(1, methods + 1):
+        min_id = 1
+        while True:
+            cur.execute(
+                "SELECT id, hash, hash_bits FROM hashes WHERE hashing_method_id = %s AND id >= %s ORDER BY id LIMIT 10000",
+                (method_id, min_id)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            total += len(rows)
+            min_id = rows[-1][0] + 1
+    return total / (time.perf_counter() - start)
+
+def insert_matches(cur, partitioned:bool, methods:int, pairs:int)->float:
+    """
+    Writes pairs of every method like MatchWriter, through COPY into a staging table. Returns rows per second
+    """
+    if partitioned:
+        for method_id in range(1, methods + 1):
+            cur.execute(f"CREATE TABLE matches_method_{method_id} PARTITION OF matches FOR VALUES IN ({method_id})")
+
+    cur.execute("DROP TABLE IF EXISTS matches_staging")
+    cur.execute("CREATE TEMP TABLE matches_staging (hashing_method_id INTEGER, hamming_distance SMALLINT, hash_id1 INTEGER, hash_id2 INTEGER)")
+    columns = "hashing_method_id, hamming_distance, hash_id1, hash_id2" if partitioned else "hamming_distance, hash_id1, hash_id2"
+
+    cur.execute("SELECT hashing_method_id, array_agg(id ORDER BY id) FROM hashes GROUP BY hashing_method_id")
+    ids = dict(cur.fetchall())
+
+    elapsed, written = 0.0, 0
+    for method_id, method_ids in ids.items():
+        pairs_of_method = (f"{method_id}\t{random.randint(0, 64)}\t{id1}\t{id2}\n" for i, id1 in enumerate(method_ids) for id2 in method_ids[i:])
+        remaining = pairs // methods
+        while remaining > 0:
+            batch = "".join(next(pairs_of_method) for _ in range(min(BATCH_SIZE, remaining)))
+            remaining -= min(BATCH_SIZE, remaining)
+
+            start = time.perf_counter()
+            cur.copy_expert("COPY matches_staging FROM STDIN", io.StringIO(batch))
+            cur.execute(f"INSERT INTO matches ({columns}) SELECT {columns} FROM matches_staging ON CONFLICT ON CONSTRAINT unique_matches DO NOTHING")
+            written += cur.rowcount
+            cur.execute("TRUNCATE matches_staging")
+            cur.connection.commit()
+            elapsed += time.perf_counter() - start
+    return written / elapsed
+
+def query_matches(cur, partitioned:bool)->float:
+    """
+    Counts close pairs of one method, the typical analysis query. Returns seconds
+    """
+    start = time.perf_counter()
+    if partitioned:
+        cur.execute("SELECT COUNT(*) FROM matches WHERE hashing_method_id = 1 AND hamming_distance <= 10")
+    else:
+        cur.execute("SELECT COUNT(*) FROM matches m JOIN hashes h ON h.id = m.hash_id1 WHERE h.hashing_method_id = 1 AND m.hamming_distance <= 10")
+    cur.fetchone()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hashes", type=int, default=20_000, help="Hashes per method")
+    parser.add_argument("--methods", type=int, default=4)
+    parser.add_argument("--pairs", type=int, default=2_000_000, help="Matches written over all methods")
+    args = parser.parse_args()
+
+    conn = connect()
+    for name, ddl, partitioned in (("before", BEFORE, False), ("after", AFTER, True)):
+        schema = f"benchmark_{name}"
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema}")
+            cur.execute(ddl)
+            random.seed(0)
+            load_hashes(cur, args.hashes, args.methods)
+            conn.commit()
+
+            hashes_per_second = read_hashes(cur, args.methods)
+            rows_per_second = insert_matches(cur, partitioned, args.methods, args.pairs)
+            cur.execute("ANALYZE matches")
+            query_seconds = query_matches(cur, partitioned)
+
+            print(f"{name:>6}: read {hashes_per_second:,.0f} hashes/s, insert {rows_per_second:,.0f} rows/s, query {query_seconds:.3f} s")
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+            conn.commit()
+    conn.close()
+
+if __name__ == "__main__":
+    main()
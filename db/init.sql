@@ -27,26 +27,106 @@ CREATE TABLE IF NOT EXISTS modified_images (
   modification_id INTEGER NOT NULL REFERENCES modifications(id)
 );
 
+-- hash holds the bits packed most significant first, hash_bits how many of them are used
 CREATE TABLE IF NOT EXISTS hashes (
   id SERIAL PRIMARY KEY,
-  hash TEXT NOT NULL,
+  hash BYTEA NOT NULL,
+  hash_bits SMALLINT NOT NULL,
   modified_image_id INTEGER NOT NULL REFERENCES modified_images(id),
   hashing_method_id INTEGER NOT NULL REFERENCES hashing_methods(id)
 );
 
+-- Rows of one hashing method are only compared with each other, so the index on hashing_method_id, id
+-- covers loading, counting and paging the hashes of a method without touching the heap.
+CREATE INDEX IF NOT EXISTS hashes_method_id ON hashes (hashing_method_id, id) INCLUDE (hash, hash_bits, modified_image_id);
+
+-- hamming_distance is the amount of differing bits, see matches_normalized for the distance divided by hash length.
+-- Partitioned by hashing method, the matcher creates the partition of a method when it starts a run (matches_method_<id>).
+-- The primary key is the only index, so every insert does one index probe. id is kept for reference but not indexed.
 CREATE TABLE IF NOT EXISTS matches (
-  id SERIAL PRIMARY KEY,
-  hamming_distance DOUBLE PRECISION NOT NULL,
+  id BIGINT GENERATED ALWAYS AS IDENTITY,
+  hashing_method_id INTEGER NOT NULL REFERENCES hashing_methods(id),
+  hamming_distance SMALLINT NOT NULL,
   hash_id1 INTEGER NOT NULL REFERENCES hashes(id),
-  hash_id2 INTEGER NOT NULL REFERENCES hashes(id)
+  hash_id2 INTEGER NOT NULL REFERENCES hashes(id),
+  CONSTRAINT unique_matches PRIMARY KEY (hashing_method_id, hash_id1, hash_id2)
+) PARTITION BY LIST (hashing_method_id);
+
+CREATE TABLE IF NOT EXISTS matches_default PARTITION OF matches DEFAULT;
+
+-- Matching progress per hashing method. Hashes above max_hash_id are not part of the run, so tiles stay stable on resume.
+CREATE TABLE IF NOT EXISTS match_runs (
+  hashing_method_id INTEGER PRIMARY KEY REFERENCES hashing_methods(id),
+  engine TEXT NOT NULL,
+  block_size INTEGER NOT NULL,
+  max_distance DOUBLE PRECISION,
+  max_hash_id INTEGER NOT NULL,
+  done BOOLEAN NOT NULL DEFAULT FALSE,
+  histogram BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+-- Tiles of a run. Matcher replicas lease pending or expired tiles with FOR UPDATE SKIP LOCKED,
+-- and mark them done in the same transaction as their matches.
+CREATE TABLE IF NOT EXISTS match_tiles (
+  hashing_method_id INTEGER NOT NULL REFERENCES match_runs(hashing_method_id) ON DELETE CASCADE,
+  row_start INTEGER NOT NULL,
+  col_start INTEGER NOT NULL,
+  pairs BIGINT NOT NULL,
+  state TEXT NOT NULL DEFAULT 'pending' CHECK (state IN ('pending', 'leased', 'done')),
+  lease_owner TEXT,
+  lease_expires_at TIMESTAMPTZ,
+  PRIMARY KEY (hashing_method_id, row_start, col_start)
+);
+
+CREATE INDEX IF NOT EXISTS match_tiles_unfinished ON match_tiles (hashing_method_id, row_start, col_start) WHERE state <> 'done';
+
+-- Distance distribution of a histogram run. Pairs are counted per modification pair, ordered so
+-- modification_id1 <= modification_id2, and whether both hashes come from the same image or user.
+-- Kept when a later run of the method does not count histograms, replaced by the next histogram run.
+CREATE TABLE IF NOT EXISTS match_histograms (
+  hashing_method_id INTEGER NOT NULL REFERENCES hashing_methods(id),
+  modification_id1 INTEGER NOT NULL REFERENCES modifications(id),
+  modification_id2 INTEGER NOT NULL REFERENCES modifications(id),
+  same_image BOOLEAN NOT NULL,
+  same_user BOOLEAN NOT NULL,
+  hamming_distance SMALLINT NOT NULL,
+  pairs BIGINT NOT NULL,
+  PRIMARY KEY (hashing_method_id, modification_id1, modification_id2, same_image, same_user, hamming_distance)
+);
+
+-- Detection rates computed from match_histograms, see /match/evaluate. modification_id is NULL for all modifications together.
+-- tpr and fpr hold the ROC curve, indexed by threshold in bits (tpr[1] is threshold 0).
+CREATE TABLE IF NOT EXISTS match_evaluations (
+  id SERIAL PRIMARY KEY,
+  hashing_method_id INTEGER NOT NULL REFERENCES hashing_methods(id),
+  modification_id INTEGER REFERENCES modifications(id),
+  label TEXT NOT NULL CHECK (label IN ('image', 'user')),
+  genuine_pairs BIGINT NOT NULL,
+  impostor_pairs BIGINT NOT NULL,
+  tpr DOUBLE PRECISION[] NOT NULL,
+  fpr DOUBLE PRECISION[] NOT NULL,
+  eer DOUBLE PRECISION NOT NULL,
+  eer_threshold SMALLINT NOT NULL,
+  best_threshold SMALLINT NOT NULL,
+  best_tpr DOUBLE PRECISION NOT NULL,
+  best_fpr DOUBLE PRECISION NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  CONSTRAINT unique_match_evaluations UNIQUE NULLS NOT DISTINCT (hashing_method_id, modification_id, label)
 );
 
 -- Ensures no duplicate hashes for unique images. This is given that path is UNIQUE because it holds a hash to a specific image.
 ALTER TABLE hashes
 ADD CONSTRAINT unique_image_hash UNIQUE (modified_image_id, hashing_method_id, hash);
 
-ALTER TABLE matches
-ADD CONSTRAINT unique_matches UNIQUE (hamming_distance, hash_id1, hash_id2);
+-- Hex strings of the hashes, as they were stored before hashes became BYTEA
+CREATE OR REPLACE VIEW hashes_hex AS
+SELECT h.id, encode(h.hash, 'hex') AS hash, h.hash_bits, h.modified_image_id, h.hashing_method_id
+FROM hashes h;
+
+CREATE OR REPLACE VIEW matches_normalized AS
+SELECT m.id, m.hashing_method_id, m.hamming_distance::DOUBLE PRECISION / h.hash_bits AS hamming_distance, m.hash_id1, m.hash_id2
+FROM matches m
+JOIN hashes h ON h.id = m.hash_id1;
 
 -- Default user if not specified
 INSERT INTO users (name) VALUES ('undefined');
@@ -0,0 +1,184 @@
+"""
+Measures the cost and quality of every registered hashing method on a synthetic corpus at several resolutions.
+Reports per image latency percentiles, images per second on one core and the peak memory used while hashing (Linux only),
+and the mean normalized hamming distance of an image to a slightly altered copy of itself (genuine) and to other images (impostor).
+Exits with 1 if a method is slower, relative to decoding, or worse than the stored baseline in benchmark_baseline.json.
+
+    python benchmark.py --images 30
+    python benchmark.py --save-baseline
+"""
+import argparse
+import dataclasses
+import io
+import json
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image, ImageEnhance
+from src import hash_image
+
+DEFAULT_BASELINE = Path(__file__).parent / "benchmark_baseline.json"
+RESOLUTIONS = ["256x256", "1024x768", "3000x2000"]
+
+@dataclasses.dataclass
+class Result:
+    method:str
+    resolution:str
+    p50_ms:float
+    p95_ms:float
+    p99_ms:float
+    images_per_second:float
+    peak_memory_kb:float
+    genuine_distance:float
+    impostor_distance:float
+
+def synthetic_image(rng:np.random.Generator, width:int, height:int)->Image.Image:
+    """
+    Random blobs: coarse noise upscaled, so the image has the low frequencies perceptual hashes look at
+    """
+    data = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    return Image.fromarray(data, "RGB").resize((width, height), Image.Resampling.BICUBIC)
+
+def altered(img:Image.Image)->Image.Image:
+    """
+    A copy a perceptual hash should still match: brighter and scaled down and back up
+    """
+    small = img.resize((img.width // 2, img.height // 2), Image.Resampling.BILINEAR)
+    return ImageEnhance.Brightness(small.resize(img.size, Image.Resampling.BILINEAR)).enhance(1.1)
+
+def encode(img:Image.Image)->bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+def decode(data:bytes)->Image.Image:
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img if img.mode == "RGB" else img.convert("RGB") # Converting copies, and the freed original would hide the peak of hashing
+
+def distance(bits1:np.ndarray, bits2:np.ndarray)->float:
+    return float(np.count_nonzero(bits1 != bits2)) / bits1.size
+
+def memory_status(field:str)->int:
+    """
+    Returns a field of /proc/self/status in bytes
+    """
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+def timed(func, inputs:list)->tuple[list, list[float], int]:
+    """
+    Calls func on every input. Returns the outputs, the latency of every call in seconds
+    and the peak resident memory above the memory in use before the first call, in bytes.
+    The peak includes the buffers of PIL, which tracemalloc does not see.
+    """
+    outputs, latencies = [], []
+    Path("/proc/self/clear_refs").write_text("5") # Resets the peak resident memory to the current
+    resident = memory_status("VmRSS")
+    for item in inputs:
+        start = time.perf_counter()
+        outputs.append(func(item))
+        latencies.append(time.perf_counter() - start)
+    return outputs, latencies, memory_status("VmHWM") - resident
+
+def measure(method_name:str | None, resolution:str, images:list[bytes], altered_images:list[bytes])->Result:
+    """
+    Times decoding the images if method_name is None, otherwise hashing the decoded images with the method,
+    so each method is charged for its own preprocessing. Runs in a fresh process, so freed memory of earlier runs does not hide the peak
+    """
+    if method_name is None:
+        _, latencies, peak = timed(lambda data: decode(data).size, images)
+        genuine, impostor = 0.0, 0.0
+    else:
+        method = hash_image.HashingMethods.hashing_methods[method_name]()
+        decoded = [decode(data) for data in images]
+        hashes, latencies, peak = timed(lambda img: method.hash_image(hash_image.PreparedImage(img)), decoded)
+
+        genuine = float(np.mean([distance(bits, method.hash_image(hash_image.PreparedImage(decode(data)))) for bits, data in zip(hashes, altered_images)]))
+        impostor = float(np.mean([distance(bits, other) for bits, other in zip(hashes, hashes[1:])]))
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return Result(
+        method_name or "decode", resolution, float(p50), float(p95), float(p99),
+        len(latencies) / sum(latencies), peak / 1024, genuine, impostor
+    )
+
+def run(images_per_resolution:int, resolutions:list[str])->list[Result]:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context, max_tasks_per_child=1) as pool:
+        for resolution in resolutions:
+            width, height = map(int, resolution.split("x"))
+            rng = np.random.default_rng(0)
+            corpus = [synthetic_image(rng, width, height) for _ in range(images_per_resolution)]
+            images = [encode(img) for img in corpus]
+            altered_images = [encode(altered(img)) for img in corpus]
+
+            for method_name in [None, *hash_image.HashingMethods.hashing_methods]:
+                results.append(pool.submit(measure, method_name, resolution, images, altered_images).result())
+
+    return results
+
+def regressions(results:list[Result], baseline:dict, tolerance:float, quality_tolerance:float)->list[str]:
+    """
+    Compares the median latency and the genuine and impostor distances of every method to the baseline.
+    Latencies are compared relative to decoding at the same resolution, so a baseline of another machine stays roughly valid
+    """
+    decode_ms = {r.resolution: r.p50_ms for r in results if r.method == "decode"}
+    found = []
+    for r in results:
+        base = baseline.get(r.method, {}).get(r.resolution)
+        base_decode = baseline.get("decode", {}).get(r.resolution)
+        if r.method == "decode" or base is None or base_decode is None:
+            continue
+
+        relative, base_relative = r.p50_ms / decode_ms[r.resolution], base["p50_ms"] / base_decode["p50_ms"]
+        if relative > base_relative * (1 + tolerance):
+            found.append(f"{r.method} at {r.resolution}: p50 {relative:.1%} of decoding, baseline {base_relative:.1%}")
+        if r.genuine_distance > base["genuine_distance"] + quality_tolerance:
+            found.append(f"{r.method} at {r.resolution}: genuine distance {r.genuine_distance:.3f}, baseline {base['genuine_distance']:.3f}")
+        if r.impostor_distance < base["impostor_distance"] - quality_tolerance:
+            found.append(f"{r.method} at {r.resolution}: impostor distance {r.impostor_distance:.3f}, baseline {base['impostor_distance']:.3f}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=30, help="Images per resolution")
+    parser.add_argument("--resolutions", nargs="+", default=RESOLUTIONS, help="WIDTHxHEIGHT")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative increase of the median latency, compared to decoding")
+    parser.add_argument("--quality-tolerance", type=float, default=0.02, help="Allowed change of the genuine and impostor distances")
+    args = parser.parse_args()
+
+    results = run(args.images, args.resolutions)
+
+    print(f"{'method':>16} {'resolution':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'img/s/core':>10} {'peak KiB':>9} {'genuine':>8} {'impostor':>8}")
+    for r in results:
+        print(f"{r.method:>16} {r.resolution:>10} {r.p50_ms:>8.2f} {r.p95_ms:>8.2f} {r.p99_ms:>8.2f} {r.images_per_second:>10.1f} {r.peak_memory_kb:>9.0f} {r.genuine_distance:>8.3f} {r.impostor_distance:>8.3f}")
+
+    if args.save_baseline:
+        baseline:dict[str, dict] = {}
+        for r in results:
+            baseline.setdefault(r.method, {})[r.resolution] = dataclasses.asdict(r)
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return
+
+    found = regressions(results, json.loads(args.baseline.read_text()), args.tolerance, args.quality_tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    if found:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from . import lib
 from . import router
 
-app = FastAPI(title="Image Hasher")
-
-app.include_router(router.router)
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    with lib.HashPool() as pool:
+        router.pool = pool
+        yield
+    router.pool = None
 
+app = FastAPI(title="Image Hasher", lifespan=lifespan)
 
+app.include_router(router.router)
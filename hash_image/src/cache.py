@@ -0,0 +1,85 @@
+from contextlib import ContextDecorator
+from pathlib import Path
+from typing import Self
+import hashlib
+import re
+import sqlite3
+import time
+from src import lru
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{128}") # Modified images are named by the blake2b digest of their pixels
+
+def image_digest(path:Path)->str:
+    """
+    Returns the digest identifying the content of an image file, without decoding it.
+    That is the file name for the content addressed files of the modifier, otherwise the blake2b digest of the file
+    """
+    if DIGEST_PATTERN.fullmatch(path.stem):
+        return path.stem
+
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(usedforsecurity=False)).hexdigest()
+
+class HashCache(ContextDecorator):
+    """
+    Hashes computed before, keyed by image digest, hashing method name and method parameters, in a local SQLite file.
+    Holds about max_entries hashes, evicting the least recently used ones on commit, see lru.LRUBound.
+    Several hashers may share the file.
+    """
+    def __init__(self, path:Path, max_entries:int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS hashes (
+            digest TEXT NOT NULL,
+            method TEXT NOT NULL,
+            params TEXT NOT NULL,
+            hash BLOB NOT NULL,
+            bits INTEGER NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (digest, method, params)
+        ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)")
+        self.conn.commit()
+        self.bound = lru.LRUBound(self.conn, "hashes", "digest, method, params", "used", max_entries)
+
+    def get(self, digest:str, method:str, params:str)->tuple[bytes, int] | None:
+        """
+        Returns the packed hash and its length in bits, or None if it is not cached
+        """
+        cur = self.conn.execute(
+            "UPDATE hashes SET used = ? WHERE digest = ? AND method = ? AND params = ? RETURNING hash, bits",
+            (time.time_ns(), digest, method, params)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+
+        return bytes(result[0]), int(result[1])
+
+    def put(self, digest:str, method:str, params:str, hash:bytes, bits:int):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes (digest, method, params, hash, bits, used) VALUES (?, ?, ?, ?, ?, ?)",
+            (digest, method, params, hash, bits, time.time_ns())
+        )
+        self.bound.add()
+
+    def commit(self):
+        self.bound.evict()
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
@@ -1,6 +1,8 @@
 import os
 import dataclasses
+from pathlib import Path
 from typing import Self
+from src.image import ImageFormat
 
 DEFAULT_POSTGRESQL_PORT = 5432
 DEFAULT_POSTGRESQL_HOST = "localhost"
@@ -8,6 +10,14 @@ DEFAULT_POSTGRESQL_DB = "p-hash"
 DEFAULT_POSTGRESQL_USER = "user"
 DEFAULT_POSTGRESQL_PASSWORD = ""  
 
+DEFAULT_HASH_WORKERS = os.cpu_count() or 1
+DEFAULT_HASH_CACHE_PATH = Path().home() / ".cache" / "p_hash" / "hash_cache" / "hashes.sqlite3"
+DEFAULT_HASH_CACHE_SIZE = 1_000_000 # Hashes, 0 disables the cache
+DEFAULT_HASH_QUEUE_PER_WORKER = 2 # Requests queued or running per worker before the hasher answers 503
+DEFAULT_MOD_IMG_PATH = Path().home() / ".cache" / "p_hash" / "mod_imgs" # Same as the modifier, so fused and modified images share their paths
+DEFAULT_MOD_IMG_FORMAT = ImageFormat.PNG
+DEFAULT_MOD_DRAFT_SIZE = 0 # Same as the modifier, smallest side JPEG sources may be decoded at for scale invariant modifications, 0 decodes in full
+
 
 @dataclasses.dataclass
 class Config:
@@ -16,6 +26,13 @@ class Config:
     postgresql_db: str
     postgresql_user: str
     postgresql_passwd: str
+    hash_workers: int
+    hash_queue_size: int
+    hash_cache_path: Path
+    hash_cache_size: int
+    modified_img_path: Path
+    mod_img_format: ImageFormat
+    mod_draft_size: int
 
     @classmethod
     def from_env(cls) -> Self:
@@ -28,11 +45,39 @@ class Config:
         pg_user: str = os.getenv("POSTGRESQL_USER") or DEFAULT_POSTGRESQL_USER
         pg_pass: str = os.getenv("POSTGRESQL_PASSWORD") or DEFAULT_POSTGRESQL_PASSWORD
 
+        workers_env: str | None = os.getenv("HASH_WORKERS")
+        workers: int = int(workers_env) if workers_env else DEFAULT_HASH_WORKERS
+
+        queue_size_env: str | None = os.getenv("HASH_QUEUE_SIZE")
+        queue_size: int = int(queue_size_env) if queue_size_env else DEFAULT_HASH_QUEUE_PER_WORKER * workers
+
+        cache_path_env: str | None = os.getenv("HASH_CACHE_PATH")
+        cache_path = Path(cache_path_env) if cache_path_env else DEFAULT_HASH_CACHE_PATH
+
+        cache_size_env: str | None = os.getenv("HASH_CACHE_SIZE")
+        cache_size: int = int(cache_size_env) if cache_size_env else DEFAULT_HASH_CACHE_SIZE
+
+        mod_img_path_env: str | None = os.getenv("MOD_IMG_PATH")
+        mod_img_path = Path(mod_img_path_env) if mod_img_path_env else DEFAULT_MOD_IMG_PATH
+
+        format_env: str | None = os.getenv("MOD_IMG_FORMAT")
+        img_format = ImageFormat(format_env) if format_env else DEFAULT_MOD_IMG_FORMAT
+
+        draft_size_env: str | None = os.getenv("MOD_DRAFT_SIZE")
+        draft_size: int = int(draft_size_env) if draft_size_env else DEFAULT_MOD_DRAFT_SIZE
+
         return cls(
             postgresql_port=pg_port,
             postgresql_host=pg_host,
             postgresql_db=pg_db,
             postgresql_user=pg_user,
-            postgresql_passwd=pg_pass
+            postgresql_passwd=pg_pass,
+            hash_workers=workers,
+            hash_queue_size=queue_size,
+            hash_cache_path=cache_path,
+            hash_cache_size=cache_size,
+            modified_img_path=mod_img_path,
+            mod_img_format=img_format,
+            mod_draft_size=draft_size
         )
 
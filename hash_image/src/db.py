@@ -11,12 +11,24 @@ class ModifiedImage:
     image_id: int
     hasing_method_id: int
 
+@dataclass
+class Image:
+    id: int
+    path: Path
+    user_id: int
+
 @dataclass
 class HashMethodIDNotFound(Exception):
     name:str
     def __str__(self) -> str:
         return f"Hashing method {self.name}, not found. Is it in the DB?"
 
+@dataclass
+class ModificationIDNotFound(Exception):
+    name:str
+    def __str__(self) -> str:
+        return f"Could not find id for modification {self.name}. Is it in the DB?"
+
 @dataclass
 class IDNotReturned(Exception):
     def __str__(self) -> str:
@@ -33,25 +45,28 @@ class Database(ContextDecorator):
         result = cur.fetchmany(fetch_amount)
 
         return [ModifiedImage(id ,p , n, hm) for id, p, n ,hm in result]
-    def get_hash_id(self, hash:str, mod_img_id:int, hashing_method:int)->int:
+    def get_hash_id(self, hash:bytes, mod_img_id:int, hashing_method:int)->int:
 
         with self.conn.cursor() as cur:
-            cur.execute("SELECT id FROM hashes WHERE hash = %s AND modified_image_id = %s AND hashing_method_id = %s", (hash,mod_img_id, hashing_method))
+            cur.execute("SELECT id FROM hashes WHERE hash = %s AND modified_image_id = %s AND hashing_method_id = %s", (psycopg2.Binary(hash),mod_img_id, hashing_method))
             result = cur.fetchone()
             if result is None:
                 raise IDNotReturned()
 
             return int(result[0])
 
-    def send_hash(self, hash: str, img_id:int, hashing_method_id:int)->int|None:
+    def send_hash(self, hash: bytes, bits:int, img_id:int, hashing_method_id:int)->int|None:
+        """
+        hash: Packed hash bits. bits: Length of the hash in bits
+        """
         command = """
-        INSERT INTO hashes (hash, modified_image_id, hashing_method_id) VALUES (%s, %s, %s) 
+        INSERT INTO hashes (hash, hash_bits, modified_image_id, hashing_method_id) VALUES (%s, %s, %s, %s) 
         ON CONFLICT ON CONSTRAINT unique_image_hash 
         DO NOTHING
         RETURNING id
         """
         with self.conn.cursor() as cur:
-            cur.execute(command, (hash, img_id,hashing_method_id))
+            cur.execute(command, (psycopg2.Binary(hash), bits, img_id,hashing_method_id))
             result = cur.fetchone()
             if result is None:
                 return None
@@ -81,6 +96,55 @@ class Database(ContextDecorator):
 
         return int(result[0])
         
+    def add_modification(self, mod_name:str)->int |None:
+        command = """
+        INSERT INTO modifications (name) VALUES (%s) 
+        ON CONFLICT (name) DO NOTHING
+        RETURNING id
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (mod_name,))
+            result = cur.fetchone()
+            if result is None:
+                return None
+
+        return int(result[0])
+
+    def get_mod_id(self, mod_name:str)->int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id FROM modifications WHERE name = (%s)", (mod_name,))
+            result = cur.fetchone()
+            if result is None:
+                raise ModificationIDNotFound(mod_name)
+
+            return int(result[0])
+
+    def add_mod_image(self, path:Path, image_id:int, mod_id:int)->int|None:
+        """
+        Records a modified image made by the fused stage. path: Where the modifier would save it, the key shared with its rows
+        """
+        command = """
+        INSERT INTO modified_images (path, image_id, modification_id) VALUES (%s, %s, %s) 
+        ON CONFLICT (path) DO NOTHING
+        RETURNING id
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (str(path), image_id, mod_id))
+            result = cur.fetchone()
+            if result is None:
+                return None
+
+        return int(result[0])
+
+    def get_mod_image_id(self, path:Path)->int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id FROM modified_images WHERE path = %s", (str(path),))
+            result = cur.fetchone()
+            if result is None:
+                raise IDNotReturned()
+
+            return int(result[0])
+
     def commit(self):
         self.conn.commit()
 
@@ -1,56 +1,162 @@
 from abc import ABC, abstractmethod
+from functools import cached_property, partial
+from pathlib import Path
+from typing import Callable, Self
 from PIL import Image
 import numpy as np
-import imagehash
+import scipy.fftpack
+
+NPY_MAGIC = b"\x93NUMPY"
+
+class PreparedImage:
+    """
+    An image decoded once, with the preprocessing steps hashing methods share.
+    Every step is computed on first request and reused by the following methods.
+    """
+    def __init__(self, img:Image.Image) -> None:
+        self.image = img
+        self._resized:dict[int, np.ndarray] = {}
+        self._dct:dict[int, np.ndarray] = {}
+
+    @classmethod
+    def open(cls, path:Path)->Self:
+        """
+        Opens any image format PIL reads, or the raw pixels of a .npy file, told apart by the start of the file.
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(NPY_MAGIC))
+
+        if magic == NPY_MAGIC:
+            pixels = np.load(path, mmap_mode="r", allow_pickle=False)
+            return cls(Image.fromarray(np.asarray(pixels)).convert("RGB"))
+
+        with Image.open(path) as open_image:
+            return cls(open_image.convert("RGB"))
+
+    @cached_property
+    def gray(self)->Image.Image:
+        return self.image.convert("L")
+
+    def resized(self, size:int)->np.ndarray:
+        """
+        Returns the grayscale pixels resized to size x size with Lanczos. Do not modify the array, it is shared
+        """
+        pixels = self._resized.get(size)
+        if pixels is None:
+            pixels = np.asarray(self.gray.resize((size, size), Image.Resampling.LANCZOS))
+            self._resized[size] = pixels
+        return pixels
+
+    def dct(self, size:int)->np.ndarray:
+        """
+        Returns the 2D DCT of resized(size). Do not modify the array, it is shared
+        """
+        dct = self._dct.get(size)
+        if dct is None:
+            dct = scipy.fftpack.dct(scipy.fftpack.dct(self.resized(size), axis=0), axis=1)
+            self._dct[size] = dct
+        return dct
 
 class HashingMethod(ABC):
+    version = 1 # Bump when a change alters the hashes, so cached hashes are not reused
+
+    def max_input_size(self)->int | None:
+        """
+        The largest side in pixels the method resizes the image to, so a larger decode is wasted. None if it needs the full image
+        """
+        return None
+
+    def params(self)->str:
+        """
+        Identifies the settings of the method in the hash cache, by default its attributes and version
+        """
+        return ",".join([f"version={self.version}", *(f"{key}={value}" for key, value in sorted(vars(self).items()))])
+
     @abstractmethod
-    def hash_image(self, img:Image.Image)->str:
+    def hash_image(self, img:PreparedImage)->np.ndarray:
+        """
+        Returns the hash as a flat boolean array of bits, most significant first
+        """
         pass
 
+    def hash_batch(self, imgs:list[PreparedImage])->np.ndarray:
+        """
+        Returns the hashes of several images as rows of bits. Methods that can work on a stack of images override this,
+        by default every image is hashed on its own
+        """
+        return np.stack([self.hash_image(img) for img in imgs])
+
 class HashingMethods:
-    hashing_methods:dict[str, type[HashingMethod]] = {}
+    hashing_methods:dict[str, Callable[[], HashingMethod]] = {}
     
     @classmethod
-    def register(cls, name:str):
+    def register(cls, name:str, **params):
+        """
+        params are passed to the method, so one class can be registered several times as variants, named like "dct-hash@16".
+        Variants share the decoded image and every preprocessing step of the same size
+        """
         def decorator(mod_cls:type[HashingMethod]):
-            cls.hashing_methods.update({name:mod_cls})
+            cls.hashing_methods.update({name:partial(mod_cls, **params) if params else mod_cls})
             return mod_cls
         return decorator
 
+@HashingMethods.register(name="averagehash@16", hash_size=16)
 @HashingMethods.register(name="averagehash")
 class AverageHash(HashingMethod):
     def __init__(self, hash_size: int = 8) -> None:
         self.hash_size = hash_size
 
-    def hash_image(self, img: Image.Image) -> str:
-        image = img.convert("L")
-        image = image.resize((self.hash_size, self.hash_size), Image.Resampling.LANCZOS)
+    def max_input_size(self) -> int | None:
+        return self.hash_size
 
-
-        pixels = np.array(image)
+    def hash_image(self, img: PreparedImage) -> np.ndarray:
+        pixels = img.resized(self.hash_size)
 
         avg = pixels.mean()
 
-        diff = pixels >= avg
+        return (pixels >= avg).flatten()
+
+    def hash_batch(self, imgs: list[PreparedImage]) -> np.ndarray:
+        pixels = np.stack([img.resized(self.hash_size) for img in imgs])
 
-        hash_bits = ''.join(['1' if x else '0' for x in diff.flatten()])
-        hash_hex = f'{int(hash_bits, 2):0{self.hash_size*self.hash_size//4}x}'
+        avg = pixels.mean(axis=(1, 2), keepdims=True)
 
-        return hash_hex
+        return (pixels >= avg).reshape(len(imgs), -1)
 
+@HashingMethods.register(name="dct-hash@16", hash_size=16)
 @HashingMethods.register(name="dct-hash")
 class DCTHash(HashingMethod):
+    """
+    The perceptual hash of imagehash.phash: the low frequencies of the DCT of a 4x larger image, compared to their median
+    """
+    highfreq_factor = 4
+
     def __init__(self, hash_size: int = 8) -> None:
         self.hash_size = hash_size
 
-    def hash_image(self, img: Image.Image) -> str:
-        arr = imagehash.phash(img, self.hash_size).hash
-        bits = arr.flatten()
-        bit_string = ''.join('1' if b else '0' for b in bits)
-        hash_len_bits = bits.size
-        hash_len_hex = hash_len_bits // 4
+    def max_input_size(self) -> int | None:
+        return self.hash_size * self.highfreq_factor
+
+    def hash_image(self, img: PreparedImage) -> np.ndarray:
+        lowfreq = img.dct(self.hash_size * self.highfreq_factor)[:self.hash_size, :self.hash_size]
+
+        return (lowfreq > np.median(lowfreq)).flatten()
+
+    def hash_batch(self, imgs: list[PreparedImage]) -> np.ndarray:
+        pixels = np.stack([img.resized(self.hash_size * self.highfreq_factor) for img in imgs])
+        dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+        lowfreq = dct[:, :self.hash_size, :self.hash_size]
 
-        return f'{int(bit_string, 2):0{hash_len_hex}x}'
+        return (lowfreq > np.median(lowfreq, axis=(1, 2), keepdims=True)).reshape(len(imgs), -1)
 
+def pack_bits(bits:np.ndarray)->bytes:
+    """
+    Packs hash bits into bytes as stored in the db. The last byte is zero padded.
+    """
+    return np.packbits(bits).tobytes()
 
+def pack_bits_batch(bits:np.ndarray)->list[bytes]:
+    """
+    Packs rows of hash bits, as returned by HashingMethod.hash_batch, like pack_bits
+    """
+    return [row.tobytes() for row in np.packbits(bits, axis=1)]
@@ -0,0 +1 @@
+../../modify_image/src/image.py
\ No newline at end of file
@@ -1,9 +1,17 @@
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Generator
+from pathlib import Path
+from typing import Callable, Generator, Self, TypeVar
+import multiprocessing
+import threading
+import numpy as np
 import psycopg2
 from src import config as cf
 from src import db
 from src import hash_image
+from src import cache
+from src import image
+from src import modification
 import time
 from PIL import Image
 import logging
@@ -17,6 +25,8 @@ logging.basicConfig(
 
 CONFIG = cf.Config.from_env()
 
+T = TypeVar("T")
+
 @dataclass
 class Hash:
     id: int
@@ -24,52 +34,272 @@ class Hash:
     modified_image_id:int
     hashing_method_id:int
 
+@dataclass
+class FusedImage:
+    """
+    A modified image of the fused stage, without its pixels. hashes: The name of every hashing method with its hash as bits
+    """
+    modification:str
+    digest:str
+    hashes:list[tuple[str, np.ndarray]]
+
+@dataclass
+class HasherBusy(Exception):
+    queue_size:int
+    def __str__(self) -> str:
+        return f"All {self.queue_size} hashing slots are taken, retry later"
+
+def fused_draft_size()->int:
+    """
+    The size JPEG sources are decoded at for the scale invariant modifications of the fused stage, 0 decodes in full.
+    With MOD_DRAFT_SIZE set it is raised to the largest max_input_size of the hashing methods, so no method gets an image smaller than it resizes to.
+    A method needing the full image turns it off
+    """
+    if CONFIG.mod_draft_size <= 0:
+        return 0
+
+    sizes = [Method().max_input_size() for Method in hash_image.HashingMethods().hashing_methods.values()]
+    if any(size is None for size in sizes):
+        return 0
+    return max([CONFIG.mod_draft_size, *sizes])
+
+def compute_hashes(paths:list[Path], names:list[str] | None = None)->list[tuple[str, np.ndarray]]:
+    """
+    Hashes the images with the hashing methods in names, or every method, without touching the db so it can run in a worker process.
+    Every image is decoded once and its preprocessing shared by the methods. With several images each method hashes them together through hash_batch.
+    Returns the name of every method with its hashes as rows of bits, in the order of paths
+    """
+    return hash_prepared([hash_image.PreparedImage.open(path) for path in paths], names)
+
+def hash_prepared(prepared:list[hash_image.PreparedImage], names:list[str] | None = None)->list[tuple[str, np.ndarray]]:
+    """
+    Hashes decoded images, see compute_hashes
+    """
+    if not prepared:
+        return []
+
+    hashes = []
+    for name, Method in hash_image.HashingMethods().hashing_methods.items():
+        if names is not None and name not in names:
+            continue
+
+        method = Method()
+        if len(prepared) > 1:
+            bits = method.hash_batch(prepared)
+        else:
+            bits = method.hash_image(prepared[0]).reshape(1, -1)
+        hashes.append((name, bits))
+
+    return hashes
+
+def compute_fused(path:Path, persist_dir:Path | None = None, format:image.ImageFormat = image.ImageFormat.PNG, mod_draft_size:int = 0)->list[FusedImage]:
+    """
+    Applies every registered modification to the image and hashes each result with every hashing method in memory,
+    without touching the db so it can run in a worker process. Replaces the modifier and hasher for one image, without writing and decoding again every modified image.
+    The image is decoded once and shared by the modifications that do not work in place. Like the modifier, with mod_draft_size JPEGs are decoded once more
+    at reduced scale for the scale invariant modifications, so the digests equal those of the modifier with the same MOD_DRAFT_SIZE.
+    Every modified image is hashed and released before the next is made, so at most one is held besides the sources.
+    persist_dir: If given, the modified images are also saved there, named like the modifier does
+    """
+    if persist_dir is not None:
+        persist_dir.mkdir(parents=True, exist_ok=True)
+
+    sources:dict[int | None, Image.Image] = {} # By draft size
+    fused:list[FusedImage] = []
+    for mod_name, Mod in modification.Modifications().modifications.items():
+        mod = Mod()
+        draft_size = mod_draft_size if mod_draft_size > 0 and mod.scale_invariant else None
+        if draft_size not in sources:
+            sources[draft_size] = image.open_image(path, draft_size)
+        source = sources[draft_size]
+        mod_img = mod.modify_image(source.copy() if mod.in_place else source)
+
+        digest = image.content_digest(mod_img)
+        if persist_dir is not None:
+            save_path = (persist_dir / digest).with_suffix(image.SUFFIXES[format])
+            if not save_path.exists():
+                image.save_image(save_path, mod_img, format)
+
+        hashes = hash_prepared([hash_image.PreparedImage(mod_img)])
+        fused.append(FusedImage(mod_name, digest, [(name, bits[0]) for name, bits in hashes]))
+        del mod_img, hashes
+
+    return fused
+
+def _warm_up():
+    """
+    Run by every worker process on start, which imports this module with PIL and SciPy before the first image arrives
+    """
+    pass
+
+class HashPool:
+    """
+    Runs compute_hashes or compute_fused in a pool of worker processes, started up front, so hashing is not serialized by the GIL of the service.
+    At most queue_size calls are queued or running. Further calls raise HasherBusy instead of waiting, so callers can back off.
+    """
+    def __init__(self, workers:int = CONFIG.hash_workers, queue_size:int = CONFIG.hash_queue_size) -> None:
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(queue_size)
+
+        context = multiprocessing.get_context("spawn") # Requests are served on threads, so forking is unsafe
+        self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_warm_up)
+        for future in [self.executor.submit(_warm_up) for _ in range(workers)]:
+            future.result()
+
+    def submit(self, fn:Callable[..., T], *args)->Future[T]:
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy(self.queue_size)
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 class Hasher:
-    def __init__(self, batch_size: int) -> None:
+    def __init__(self, batch_size: int, pool:HashPool | None = None) -> None:
+        """
+        pool: Computes the hashes in worker processes, without it they are computed in the calling thread. Hashes are always written to the db from here
+        """
         self.batch_size: int = batch_size # How many images should be processed before being sent to db
         self.pending = 0
+        self.pool = pool
+        self.cache = cache.HashCache(CONFIG.hash_cache_path, CONFIG.hash_cache_size) if CONFIG.hash_cache_size > 0 else None
         self.database = db.Database(CONFIG.postgresql_db, 
                                     CONFIG.postgresql_user, 
                                     CONFIG.postgresql_passwd, 
                                     CONFIG.postgresql_host, 
                                     CONFIG.postgresql_port)
-    def start_iter(self, img_obj:db.ModifiedImage)->Generator[Image]:
+    def start_iter(self, imgs:list[db.ModifiedImage])->Generator[Hash]:
         """
         Ensures that modifications are commited to db when there are no more images, even if batch_size is not hit
         """
         try:
-            for hash in self._process_iter(img_obj):
+            for hash in self._process_iter(imgs):
+                yield hash
+        finally:
+            self.close()
+
+    def start_fused_iter(self, img:db.Image, persist:bool = False)->Generator[Hash]:
+        """
+        Like start_iter for the fused stage, which modifies and hashes a loaded image at once, see compute_fused
+        """
+        try:
+            for hash in self._fused_iter(img, persist):
                 yield hash
         finally:
-            if self.pending > 0:
-                self.database.commit()
-            self.database.close()
+            self.close()
+
+    def close(self):
+        if self.pending > 0:
+            self.database.commit()
+        self.database.close()
+        if self.cache is not None:
+            self.cache.commit()
+            self.cache.close()
 
-    def _process_iter(self,img: db.ModifiedImage )->Generator[Hash]:
+    def _process_iter(self, imgs:list[db.ModifiedImage])->Generator[Hash]:
         """
-        Hashes one image and returns all hashes from hashing method(s)
+        Hashes the images and returns all hashes from hashing method(s), see compute_hashes.
+        Hashes found in the cache are not computed, so images with every hash cached are never decoded.
+        Raises HasherBusy before hashing if the pool is full.
         """
-        for name, Method in hash_image.HashingMethods().hashing_methods.items():
-            logger.info(f"Processing hashing_method: {name}, img: {img.image_path.name}")
+        methods = {name: Method() for name, Method in hash_image.HashingMethods().hashing_methods.items()}
+        params = {name: method.params() for name, method in methods.items()}
+        hashes:dict[str, list[tuple[bytes, int] | None]] = {name: [None] * len(imgs) for name in methods}
+
+        digests = [cache.image_digest(img.image_path) for img in imgs] if self.cache is not None else []
+        if self.cache is not None:
+            for name in methods:
+                hashes[name] = [self.cache.get(digest, name, params[name]) for digest in digests]
+            self.cache.commit() # Lookups update the recently used time, do not hold the write lock while hashing
 
-            with Image.open(img.image_path) as open_image:
-                loaded_img = open_image.convert("RGB").copy()
+        missing = [i for i in range(len(imgs)) if any(hashes[name][i] is None for name in methods)]
+        if missing:
+            paths = [imgs[i].image_path for i in missing]
+            names = [name for name in methods if any(hashes[name][i] is None for i in missing)]
+            if self.pool is not None:
+                computed = self.pool.submit(compute_hashes, paths, names).result()
+            else:
+                computed = compute_hashes(paths, names)
+
+            for name, bits in computed:
+                for i, hash in zip(missing, hash_image.pack_bits_batch(bits)):
+                    hashes[name][i] = (hash, bits.shape[1])
+                    if self.cache is not None:
+                        self.cache.put(digests[i], name, params[name], hash, bits.shape[1])
+            if self.cache is not None:
+                self.cache.commit()
+
+        for name, method_hashes in hashes.items():
+            logger.info(f"Processing hashing_method: {name}, images: {len(imgs)}")
 
-            hash = Method().hash_image(loaded_img)
             hash_method_id = self.database.add_hash_method(name) or self.database.get_hash_method_id(name)
 
-            self.pending += 1
+            for img, (hash, bits) in zip(imgs, method_hashes):
+                self.pending += 1
+
+                if self.pending >= self.batch_size:
+                    self.database.commit()
+                    self.pending = 0
+                id = self.database.send_hash(hash, bits, img.id, hash_method_id)
+                if id is None:
+                    logging.info(f"Hash {hash.hex()} from image {img.id} with method {hash_method_id} already found in db")
+                    continue
+
+                yield Hash(id, hash.hex(), img.id, hash_method_id)
+
+    def _fused_iter(self, img:db.Image, persist:bool)->Generator[Hash]:
+        """
+        Modifies and hashes the image, then records every modified image and its hashes.
+        Modified images are recorded by the path the modifier would save them at, so both stages share rows, but only exist there with persist.
+        The hashes are put in the cache, for hashing persisted images later.
+        Raises HasherBusy before hashing if the pool is full.
+        """
+        fmt = CONFIG.mod_img_format
+        persist_dir = CONFIG.modified_img_path if persist else None
+        if self.pool is not None:
+            fused = self.pool.submit(compute_fused, img.path, persist_dir, fmt, fused_draft_size()).result()
+        else:
+            fused = compute_fused(img.path, persist_dir, fmt, fused_draft_size())
+
+        methods = {name: Method() for name, Method in hash_image.HashingMethods().hashing_methods.items()}
+        for mod_img in fused:
+            logger.info(f"Processing fused modification: {mod_img.modification}, img: {img.path.name}")
+
+            mod_id = self.database.add_modification(mod_img.modification) or self.database.get_mod_id(mod_img.modification)
+            path = (CONFIG.modified_img_path / mod_img.digest).with_suffix(image.SUFFIXES[fmt])
+            mod_img_id = self.database.add_mod_image(path, img.id, mod_id) or self.database.get_mod_image_id(path)
+
+            for name, bits in mod_img.hashes:
+                hash = hash_image.pack_bits(bits)
+                if self.cache is not None:
+                    self.cache.put(mod_img.digest, name, methods[name].params(), hash, bits.size)
+
+                hash_method_id = self.database.add_hash_method(name) or self.database.get_hash_method_id(name)
 
-            if self.pending >= self.batch_size:
-                self.database.commit()
-                self.pending = 0
-            id = self.database.send_hash(hash, img.id, hash_method_id) 
-            if id is None:
-                logging.info(f"Hash {hash} from image {img.id} with method {hash_method_id} already found in db")
-                continue
+                self.pending += 1
+                if self.pending >= self.batch_size:
+                    self.database.commit()
+                    self.pending = 0
+                id = self.database.send_hash(hash, bits.size, mod_img_id, hash_method_id)
+                if id is None:
+                    logging.info(f"Hash {hash.hex()} from image {mod_img_id} with method {hash_method_id} already found in db")
+                    continue
 
-            yield Hash(id, hash, img.id, hash_method_id)
+                yield Hash(id, hash.hex(), mod_img_id, hash_method_id)
 
 def open_image(img: db.ModifiedImage):
     Image.open(img.image_path)
@@ -0,0 +1 @@
+../../modify_image/src/lru.py
\ No newline at end of file
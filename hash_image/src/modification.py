@@ -0,0 +1 @@
+../../modify_image/src/modification.py
\ No newline at end of file
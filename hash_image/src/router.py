@@ -1,14 +1,17 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from . import lib
 from .lib import CONFIG, logger
 import time
 import psycopg2
-from .db import ModifiedImage
+from .db import Image, ModifiedImage
 from pathlib import Path
+from typing import Iterator
 
 router = APIRouter()
 
+pool:lib.HashPool | None = None # Set by the app on startup
+
 class ModImageInput(BaseModel):
     id:int
     path:str
@@ -21,6 +24,22 @@ class HashRequest(BaseModel):
     modified_image: ModImageInput
     limit: int
 
+class ImageInput(BaseModel):
+    id:int
+    path:str
+    user_id:int
+    def into_db_image(self):
+        return Image(self.id, Path(self.path), self.user_id)
+
+class FusedRequest(BaseModel):
+    image: ImageInput
+    batch_size: int # Hashes written before each commit, every hash of the image is returned
+    persist: bool = False
+
+class HashBatchRequest(BaseModel):
+    modified_images: list[ModImageInput]
+    batch_size: int # Hashes written before each commit, every hash of the images is returned
+
 class HashResponse(BaseModel):
     id:int
     hash:str
@@ -30,23 +49,50 @@ class HashResponse(BaseModel):
 
 @router.post("/hash/next")
 def hash_image(req:HashRequest):
+    return hash_images([req.modified_image.into_db_modimage()], req.limit, req.limit)
+
+@router.post("/hash/batch")
+def hash_batch(req:HashBatchRequest):
+    """
+    Hashes several modified images at once, letting the hashing methods work on all of them together.
+    Every hash is returned, as stopping early would leave the hashes of the last images unwritten
+    """
+    return hash_images([img.into_db_modimage() for img in req.modified_images], req.batch_size)
+
+@router.post("/hash/fused")
+def hash_fused(req:FusedRequest):
+    """
+    Modifies a loaded image with every modification and hashes the results in memory, replacing /modify/next and /hash/next.
+    The modified images are only saved with persist. Every hash is returned, as the hashes of the image cannot be requested again
+    """
     wait_for_db(CONFIG.postgresql_host, CONFIG.postgresql_port, CONFIG.postgresql_user, CONFIG.postgresql_passwd, CONFIG.postgresql_db)
-    hashes = []
+    return collect_hashes(lib.Hasher(req.batch_size, pool).start_fused_iter(req.image.into_db_image(), req.persist))
 
-    loader = lib.Hasher(req.limit)
+def hash_images(imgs:list[ModifiedImage], batch_size:int, limit:int | None = None):
+    wait_for_db(CONFIG.postgresql_host, CONFIG.postgresql_port, CONFIG.postgresql_user, CONFIG.postgresql_passwd, CONFIG.postgresql_db)
+    return collect_hashes(lib.Hasher(batch_size, pool).start_iter(imgs), limit)
+
+def collect_hashes(found:Iterator[lib.Hash], limit:int | None = None):
+    """
+    Returns the hashes found, stopping after limit of them if given
+    """
+    hashes = []
 
-    for hash in loader.start_iter(req.modified_image.into_db_modimage()):
-        hashes.append(
-            HashResponse(
-                id=hash.id,
-                hash=hash.hash,
-                mod_img_id=hash.modified_image_id,
-                hash_method_id=hash.hashing_method_id
+    try:
+        for hash in found:
+            hashes.append(
+                HashResponse(
+                    id=hash.id,
+                    hash=hash.hash,
+                    mod_img_id=hash.modified_image_id,
+                    hash_method_id=hash.hashing_method_id
+                )
             )
-        )
 
-        if len(hashes) >= req.limit:
-            break
+            if limit is not None and len(hashes) >= limit:
+                break
+    except lib.HasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
     return {"hashes": hashes}
 
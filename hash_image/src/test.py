@@ -0,0 +1,321 @@
+import unittest
+import tempfile
+import itertools
+from unittest.mock import MagicMock, patch
+from fastapi.testclient import TestClient
+from pathlib import Path
+from PIL import Image
+import imagehash
+import numpy as np
+from src import hash_image
+from src import lib
+from src import cache
+from src import image
+from src import modification
+from src import router
+from src import app
+
+class ImageFactory():
+    @staticmethod
+    def random_image(width:int = 100, height:int = 80):
+        data = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        return Image.fromarray(data, "RGB")
+
+class TestPreparedImage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.img = ImageFactory.random_image()
+
+    def test_open(self):
+        with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
+            self.img.save(tmp.name)
+            prepared = hash_image.PreparedImage.open(Path(tmp.name))
+
+        self.assertEqual(prepared.image.tobytes(), self.img.tobytes())
+
+    def test_open_npy(self):
+        with tempfile.NamedTemporaryFile(suffix=".npy") as tmp:
+            np.save(tmp.name, np.asarray(self.img))
+            prepared = hash_image.PreparedImage.open(Path(tmp.name))
+
+        self.assertEqual(prepared.image.tobytes(), self.img.tobytes())
+
+    def test_resized_once(self):
+        prepared = hash_image.PreparedImage(self.img)
+        self.assertIs(prepared.resized(8), prepared.resized(8))
+        self.assertEqual(prepared.resized(32).shape, (32, 32))
+
+class TestImageFormats(unittest.TestCase):
+    def test_same_hashes(self):
+        """
+        Every format the modifier writes gives the hashes of the image itself, whatever its mode. PNG cannot hold CMYK
+        """
+        rgb = ImageFactory.random_image()
+        images = {
+            "P": rgb.quantize(64), "L": rgb.convert("L"), "RGBA": rgb.convert("RGBA"), "CMYK": rgb.convert("CMYK"),
+            "RGBA transparent": Image.merge("RGBA", (*rgb.split(), Image.new("L", rgb.size, 0))),
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, img in images.items():
+                expected = lib.hash_prepared([hash_image.PreparedImage(img.convert("RGB"))])
+                for format in image.ImageFormat:
+                    if img.mode == "CMYK" and format != image.ImageFormat.NPY:
+                        continue
+
+                    path = (Path(tmp) / f"{name}-{format.value}").with_suffix(image.SUFFIXES[format])
+                    image.save_image(path, img, format)
+                    for (method, bits), (_, expected_bits) in zip(lib.compute_hashes([path]), expected):
+                        np.testing.assert_array_equal(bits, expected_bits, f"{name} {format.value} {method}")
+
+class TestHashingMethods(unittest.TestCase):
+    def test_average_hash(self):
+        for _ in range(10):
+            img = ImageFactory.random_image()
+            pixels = np.array(img.convert("L").resize((8, 8), Image.Resampling.LANCZOS))
+
+            bits = hash_image.AverageHash().hash_image(hash_image.PreparedImage(img))
+            np.testing.assert_array_equal(bits, (pixels >= pixels.mean()).flatten())
+
+    def test_dct_hash_is_phash(self):
+        for _ in range(10):
+            img = ImageFactory.random_image()
+
+            bits = hash_image.DCTHash().hash_image(hash_image.PreparedImage(img))
+            np.testing.assert_array_equal(bits, imagehash.phash(img).hash.flatten())
+
+    def test_variants(self):
+        img = ImageFactory.random_image()
+        methods = hash_image.HashingMethods.hashing_methods
+        self.assertEqual(list(methods), ["averagehash", "averagehash@16", "dct-hash", "dct-hash@16"])
+
+        bits = methods["dct-hash@16"]().hash_image(hash_image.PreparedImage(img))
+        np.testing.assert_array_equal(bits, imagehash.phash(img, 16).hash.flatten())
+        self.assertEqual(methods["averagehash@16"]().hash_image(hash_image.PreparedImage(img)).size, 256)
+
+    def test_hash_batch(self):
+        imgs = [hash_image.PreparedImage(ImageFactory.random_image()) for _ in range(10)]
+        for Method in hash_image.HashingMethods.hashing_methods.values():
+            method = Method()
+            expected = np.stack([method.hash_image(img) for img in imgs])
+
+            np.testing.assert_array_equal(method.hash_batch(imgs), expected)
+            np.testing.assert_array_equal(hash_image.HashingMethod.hash_batch(method, imgs), expected)
+
+    def test_max_input_size(self):
+        img = hash_image.PreparedImage(ImageFactory.random_image())
+        for Method in hash_image.HashingMethods.hashing_methods.values():
+            method = Method()
+            method.hash_image(img)
+            self.assertIn(method.max_input_size(), img._resized)
+
+    def test_pack_bits_batch(self):
+        bits = np.random.randint(0, 2, (5, 64)).astype(bool)
+        self.assertEqual(hash_image.pack_bits_batch(bits), [hash_image.pack_bits(row) for row in bits])
+
+    def test_pack_bits(self):
+        bits = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1], dtype=bool)
+        self.assertEqual(hash_image.pack_bits(bits), b"\x81\x80")
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.HashCache(Path(self.tmp.name) / "hashes.sqlite3", max_entries=2)
+
+    def tearDown(self) -> None:
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def test_get(self):
+        self.cache.put("a", "dct-hash", "hash_size=8", b"\x01\x02", 16)
+
+        self.assertEqual(self.cache.get("a", "dct-hash", "hash_size=8"), (b"\x01\x02", 16))
+        self.assertIsNone(self.cache.get("a", "dct-hash", "hash_size=16"))
+        self.assertIsNone(self.cache.get("a", "averagehash", "hash_size=8"))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", "dct-hash", "", b"a", 8)
+        self.cache.put("b", "dct-hash", "", b"b", 8)
+        self.cache.get("a", "dct-hash", "")
+        self.cache.put("c", "dct-hash", "", b"c", 8)
+        self.cache.commit()
+
+        self.assertIsNone(self.cache.get("b", "dct-hash", ""))
+        self.assertIsNotNone(self.cache.get("a", "dct-hash", ""))
+        self.assertIsNotNone(self.cache.get("c", "dct-hash", ""))
+
+    def test_counts_rows_in_batches(self):
+        big = cache.HashCache(Path(self.tmp.name) / "big.sqlite3", max_entries=300) # Counted every 3 added hashes
+        count = lambda: big.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        for i in range(301):
+            big.put(str(i), "dct-hash", "", b"a", 8)
+        big.commit()
+        self.assertEqual(count(), 300)
+
+        big.put("x", "dct-hash", "", b"a", 8)
+        big.commit()
+        self.assertEqual(count(), 301)
+
+        big.put("y", "dct-hash", "", b"a", 8)
+        big.put("z", "dct-hash", "", b"a", 8)
+        big.commit()
+        self.assertEqual(count(), 300)
+        big.close()
+
+    def test_counts_rows_over_instances(self):
+        """
+        Every request of the hasher opens the cache again and adds only a few hashes, the count is kept in the file
+        """
+        path = Path(self.tmp.name) / "shared.sqlite3"
+        for i in range(200):
+            with cache.HashCache(path, max_entries=600) as shared: # Counted every 6 added hashes
+                for method in ("averagehash", "dct-hash", "averagehash@16", "dct-hash@16"):
+                    shared.put(str(i), method, "", b"a", 8)
+
+        with cache.HashCache(path, max_entries=600) as shared:
+            self.assertLess(shared.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0], 600 + shared.bound.evict_every)
+
+    def test_image_digest(self):
+        digest = "ab" * 64
+        self.assertEqual(cache.image_digest(Path(f"/missing/{digest}.png")), digest)
+
+        path = Path(self.tmp.name) / "image.png"
+        ImageFactory.random_image().save(path)
+        self.assertEqual(cache.image_digest(path), cache.image_digest(path))
+        self.assertEqual(len(cache.image_digest(path)), 128)
+
+    def test_params(self):
+        self.assertNotEqual(hash_image.DCTHash(8).params(), hash_image.DCTHash(16).params())
+
+class TestHashPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = [Path(self.tmp.name) / f"{i}.png" for i in range(20)]
+        for path in self.paths:
+            ImageFactory.random_image(400, 400).save(path)
+
+        self.pool = lib.HashPool(workers=1, queue_size=1)
+
+    def tearDown(self) -> None:
+        self.pool.close()
+        self.tmp.cleanup()
+
+    def test_same_as_in_process(self):
+        expected = lib.compute_hashes(self.paths)
+        hashes = self.pool.submit(lib.compute_hashes, self.paths).result()
+
+        self.assertEqual([name for name, _ in hashes], [name for name, _ in expected])
+        for (_, bits), (_, expected_bits) in zip(hashes, expected):
+            np.testing.assert_array_equal(bits, expected_bits)
+
+    def test_busy(self):
+        future = self.pool.submit(lib.compute_hashes, self.paths)
+        with self.assertRaises(lib.HasherBusy):
+            self.pool.submit(lib.compute_hashes, self.paths)
+        future.result()
+
+class TestComputeFused(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "source.png"
+        self.img = ImageFactory.random_image(300, 200)
+        self.img.save(self.path)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_same_as_modify_then_hash(self):
+        fused = lib.compute_fused(self.path)
+
+        self.assertEqual([f.modification for f in fused], list(modification.Modifications.modifications))
+        for f, Mod in zip(fused, modification.Modifications.modifications.values()):
+            mod_img = Mod().modify_image(self.img.copy())
+            self.assertEqual(f.digest, image.content_digest(mod_img))
+
+            mod_path = Path(self.tmp.name) / f"{f.digest}.png"
+            image.save_image(mod_path, mod_img)
+            for (name, bits), (expected_name, expected_bits) in zip(f.hashes, lib.compute_hashes([mod_path])):
+                self.assertEqual(name, expected_name)
+                np.testing.assert_array_equal(bits, expected_bits[0])
+
+    def test_draft(self):
+        """
+        With a draft size, scale invariant modifications of a JPEG get the reduced decode of the modifier, the others the full one
+        """
+        path = Path(self.tmp.name) / "source.jpg"
+        ImageFactory.random_image(800, 600).save(path)
+
+        fused = lib.compute_fused(path, mod_draft_size=64)
+        for f, Mod in zip(fused, modification.Modifications.modifications.values()):
+            source = image.open_image(path, 64 if Mod.scale_invariant else None)
+            self.assertEqual(f.digest, image.content_digest(Mod().modify_image(source.copy())), f.modification)
+
+    def test_draft_size(self):
+        """
+        The fused stage never drafts below the largest input of the hashing methods, 64 for dct-hash@16
+        """
+        for mod_draft_size, expected in ((0, 0), (16, 64), (100, 100)):
+            with patch.object(lib.CONFIG, "mod_draft_size", mod_draft_size):
+                self.assertEqual(lib.fused_draft_size(), expected)
+
+        with patch.object(lib.CONFIG, "mod_draft_size", 16), \
+                patch.dict(hash_image.HashingMethods.hashing_methods, {"full": lambda: MagicMock(max_input_size=lambda: None)}):
+            self.assertEqual(lib.fused_draft_size(), 0)
+
+    def test_persist(self):
+        persist_dir = Path(self.tmp.name) / "mod_imgs"
+        lib.compute_fused(self.path)
+        self.assertFalse(persist_dir.exists())
+
+        fused = lib.compute_fused(self.path, persist_dir, image.ImageFormat.NPY)
+        for f in fused:
+            self.assertTrue((persist_dir / f"{f.digest}.npy").exists())
+
+class TestCollectHashes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.hashes = [lib.Hash(i, "00", i, 1) for i in range(150)]
+
+    def test_limit(self):
+        self.assertEqual(len(router.collect_hashes(iter(self.hashes), 100)["hashes"]), 100)
+
+    def test_every_hash(self):
+        """
+        Without a limit, as for the fused stage, the generator runs to its end so every hash is written
+        """
+        self.assertEqual(len(router.collect_hashes(iter(self.hashes))["hashes"]), 150)
+
+class TestHashBatchEndpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = [Path(self.tmp.name) / f"{i}.png" for i in range(5)]
+        for path in self.paths:
+            ImageFactory.random_image().save(path)
+
+        self.database = MagicMock()
+        self.database.send_hash.side_effect = itertools.count(1)
+        self.patchers = [
+            patch.object(router, "wait_for_db"),
+            patch.object(lib.db, "Database", return_value=self.database),
+            patch.object(lib.CONFIG, "hash_cache_size", 0),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self) -> None:
+        for patcher in self.patchers:
+            patcher.stop()
+        self.tmp.cleanup()
+
+    def test_every_hash(self):
+        """
+        A batch size below the amount of hashes only sets how often they are committed
+        """
+        modified_images = [{"id": i, "path": str(path), "image_id": 1, "modification_id": 1} for i, path in enumerate(self.paths)]
+        response = TestClient(app.app).post("/hash/batch", json={"modified_images": modified_images, "batch_size": 3})
+
+        expected = len(self.paths) * len(hash_image.HashingMethods.hashing_methods)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["hashes"]), expected)
+        self.assertEqual(self.database.send_hash.call_count, expected)
+        self.database.close.assert_called_once()
+
+if __name__ == "__main__":
+    unittest.main()
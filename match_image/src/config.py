@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 import dataclasses
+import socket
 from typing import Self
 
 DEFAULT_MOD_IMG_PATH = Path().home() / ".cache" / "p_hash" / "mod_imgs"
@@ -12,6 +13,13 @@ DEFAULT_POSTGRESQL_DB = "p-hash"
 DEFAULT_POSTGRESQL_USER = "user"
 DEFAULT_POSTGRESQL_PASSWORD = ""  
 
+DEFAULT_MATCH_ENGINE = "numpy"
+DEFAULT_MATCH_BLOCK_SIZE = 256
+DEFAULT_MATCH_FLUSH_ROWS = 100_000
+DEFAULT_MATCH_FLUSH_INTERVAL = 5.0
+DEFAULT_MATCH_WORKERS = os.cpu_count() or 1
+DEFAULT_MATCH_LEASE_SECONDS = 600
+
 
 @dataclasses.dataclass
 class Config:
@@ -22,6 +30,13 @@ class Config:
     postgresql_db: str
     postgresql_user: str
     postgresql_passwd: str
+    match_engine: str
+    match_block_size: int
+    match_flush_rows: int
+    match_flush_interval: float
+    match_workers: int
+    match_lease_seconds: int
+    matcher_id: str
 
     @classmethod
     def from_env(cls) -> Self:
@@ -39,6 +54,24 @@ class Config:
         pg_user: str = os.getenv("POSTGRESQL_USER") or DEFAULT_POSTGRESQL_USER
         pg_pass: str = os.getenv("POSTGRESQL_PASSWORD") or DEFAULT_POSTGRESQL_PASSWORD
 
+        match_engine: str = os.getenv("MATCH_ENGINE") or DEFAULT_MATCH_ENGINE
+        block_size_env: str | None = os.getenv("MATCH_BLOCK_SIZE")
+        block_size: int = int(block_size_env) if block_size_env else DEFAULT_MATCH_BLOCK_SIZE
+
+        flush_rows_env: str | None = os.getenv("MATCH_FLUSH_ROWS")
+        flush_rows: int = int(flush_rows_env) if flush_rows_env else DEFAULT_MATCH_FLUSH_ROWS
+
+        flush_interval_env: str | None = os.getenv("MATCH_FLUSH_INTERVAL")
+        flush_interval: float = float(flush_interval_env) if flush_interval_env else DEFAULT_MATCH_FLUSH_INTERVAL
+
+        workers_env: str | None = os.getenv("MATCH_WORKERS")
+        workers: int = int(workers_env) if workers_env else DEFAULT_MATCH_WORKERS
+
+        lease_env: str | None = os.getenv("MATCH_LEASE_SECONDS")
+        lease_seconds: int = int(lease_env) if lease_env else DEFAULT_MATCH_LEASE_SECONDS
+
+        matcher_id: str = os.getenv("MATCHER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
         return cls(
             modified_img_path=mod_img_path,
             input_img_path=input_img_path,
@@ -46,6 +79,13 @@ class Config:
             postgresql_host=pg_host,
             postgresql_db=pg_db,
             postgresql_user=pg_user,
-            postgresql_passwd=pg_pass
+            postgresql_passwd=pg_pass,
+            match_engine=match_engine,
+            match_block_size=block_size,
+            match_flush_rows=flush_rows,
+            match_flush_interval=flush_interval,
+            match_workers=workers,
+            match_lease_seconds=lease_seconds,
+            matcher_id=matcher_id
         )
 
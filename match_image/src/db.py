@@ -1,9 +1,20 @@
 from contextlib import ContextDecorator
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from typing import  Self
+from typing import  TYPE_CHECKING, Self, Sequence
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import asyncio
+import io
+import time
+import logging
 from . import config as cf
 from dataclasses import dataclass
 
+if TYPE_CHECKING:
+    from .engine import DistanceHistogram
+    from .evaluation import Evaluation
+
 class EmptyDatabaseError(Exception):
     def __str__(self) -> str:
         return "The database is empty"
@@ -16,16 +27,42 @@ class HashNotFoundError(Exception):
 
 @dataclass
 class Hash:
+    """
+    hash: Packed hash bits, most significant first. bits: Length of the hash in bits
+    """
     id:int
-    hash:str
+    hash:bytes
+    bits:int
     image_id:int | None= None
     hash_method_id:int | None= None
+    modification_id:int | None= None
+    user_id:int | None= None
 
 @dataclass
 class HashMethod:
     id:int
     name:str | None = None
 
+@dataclass
+class MatchRun:
+    hashing_method_id:int
+    engine:str
+    block_size:int
+    max_distance:float | None
+    max_hash_id:int
+    done:bool = False
+    histogram:bool = False
+
+@dataclass
+class MatchRunProgress:
+    hashing_method_id:int
+    done:bool
+    tiles_pending:int
+    tiles_leased:int
+    tiles_done:int
+    pairs_done:int
+    pairs_total:int
+
 @dataclass
 class IDNotReturned(Exception):
     def __str__(self) -> str:
@@ -47,15 +84,15 @@ class Database(ContextDecorator):
     def commit(self):
         self.conn.commit()
 
-    def add_hamming_distance(self, hd:float, img_id1:int, img_id2:int)->int|None:
+    def add_hamming_distance(self, hd:int, img_id1:int, img_id2:int, method_id:int)->int|None:
         command = """
-        INSERT INTO matches (hamming_distance, hash_id1, hash_id2) 
-        VALUES (%s, %s, %s)
+        INSERT INTO matches (hashing_method_id, hamming_distance, hash_id1, hash_id2) 
+        VALUES (%s, %s, %s, %s)
         ON CONFLICT ON CONSTRAINT unique_matches DO NOTHING
         RETURNING id
         """
         with self.conn.cursor() as cur:
-            cur.execute(command, (hd, img_id1, img_id2))
+            cur.execute(command, (method_id, hd, img_id1, img_id2))
             result = cur.fetchone()
             if result is None:
                 return None
@@ -65,7 +102,7 @@ class Database(ContextDecorator):
     def get_hash(self, id:int, method_id:int):
         cur = self.conn.cursor()
         command = """
-        SELECT h.id, h.hash 
+        SELECT h.id, h.hash, h.hash_bits
         FROM hashes h
         WHERE h.hashing_method_id = (%s) AND h.id = (%s);
             """
@@ -74,20 +111,28 @@ class Database(ContextDecorator):
         if result is None:
             raise HashNotFoundError(id)
 
-        return Hash(id = result[0], hash = result[1])
+        return Hash(id = result[0], hash = bytes(result[1]), bits = result[2])
 
-    def get_hashes(self, amount:int, start:int, method_id:int):
+    def get_hashes(self, amount:int, start:int, method_id:int, stop:int | None = None):
+        """
+        Gets hashes of a method with id >= start, and id <= stop if given
+        """
         cur = self.conn.cursor()
         command = """
-        SELECT h.id, h.hash
+        SELECT h.id, h.hash, h.hash_bits, mi.image_id, mi.modification_id, i.user_id
         FROM hashes h
-        WHERE h.hashing_method_id = (%s) AND h.id >= (%s)
+        JOIN modified_images mi ON mi.id = h.modified_image_id
+        JOIN images i ON i.id = mi.image_id
+        WHERE h.hashing_method_id = (%s) AND h.id >= (%s) AND (%s IS NULL OR h.id <= %s)
         ORDER BY h.id
         LIMIT %s
         """
-        cur.execute(command, (method_id, start, amount))
+        cur.execute(command, (method_id, start, stop, stop, amount))
         result = cur.fetchmany(amount)
-        return [Hash(id, hash) for id, hash in result]
+        return [
+            Hash(id, bytes(hash), bits, image_id, method_id, modification_id, user_id)
+            for id, hash, bits, image_id, modification_id, user_id in result
+        ]
 
     def get_hash_methods(self, amount:int, start:int)->list[HashMethod]:
         """
@@ -107,6 +152,258 @@ class Database(ContextDecorator):
         return [HashMethod(id[0]) for id in result]
 
 
+    def get_max_hash_id(self, method_id:int)->int | None:
+        """
+        Highest hash id of a hashing method, None if it has no hashes
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT MAX(id) FROM hashes WHERE hashing_method_id = %s", (method_id,))
+            result = cur.fetchone()
+
+        if result is None or result[0] is None:
+            return None
+        return int(result[0])
+
+    def get_match_run(self, method_id:int)->MatchRun | None:
+        command = """
+        SELECT hashing_method_id, engine, block_size, max_distance, max_hash_id, done, histogram
+        FROM match_runs
+        WHERE hashing_method_id = %s
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (method_id,))
+            result = cur.fetchone()
+
+        if result is None:
+            return None
+        return MatchRun(*result)
+
+    def get_hash_ids(self, method_id:int, max_id:int)->list[int]:
+        """
+        Ids of the hashes of a method up to max_id, in the order they are matched
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id FROM hashes WHERE hashing_method_id = %s AND id <= %s ORDER BY id", (method_id, max_id))
+            return [id for id, in cur.fetchall()]
+
+    def match_tile(self, method_id:int, rows:tuple[int, int], cols:tuple[int, int], max_distance:float | None, checkpoint:tuple[int, int])->int:
+        """
+        Matches the hashes with ids in rows against those in cols with one INSERT ... SELECT, and marks the tile done.
+        rows, cols: Inclusive id ranges. checkpoint: (row_start, col_start) of the tile.
+        Only pairs with id1 <= id2 and, if max_distance is given, a normalized distance at or below it are inserted.
+        Returns the amount of new rows in matches.
+        """
+        command = """
+        WITH a AS (
+          SELECT id, hash_bits, ('x' || encode(hash, 'hex'))::varbit AS bits
+          FROM hashes WHERE hashing_method_id = %(method_id)s AND id BETWEEN %(row_first)s AND %(row_last)s
+        ), b AS (
+          SELECT id, ('x' || encode(hash, 'hex'))::varbit AS bits
+          FROM hashes WHERE hashing_method_id = %(method_id)s AND id BETWEEN %(col_first)s AND %(col_last)s
+        )
+        INSERT INTO matches (hashing_method_id, hamming_distance, hash_id1, hash_id2)
+        SELECT %(method_id)s, d.distance, d.hash_id1, d.hash_id2
+        FROM (
+          SELECT bit_count(a.bits # b.bits) AS distance, a.hash_bits, a.id AS hash_id1, b.id AS hash_id2
+          FROM a JOIN b ON a.id <= b.id
+        ) d
+        WHERE %(max_distance)s::DOUBLE PRECISION IS NULL OR d.distance <= floor(%(max_distance)s * d.hash_bits + 1e-9)
+        ON CONFLICT ON CONSTRAINT unique_matches DO NOTHING
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, {
+                "method_id": method_id,
+                "row_first": rows[0], "row_last": rows[1],
+                "col_first": cols[0], "col_last": cols[1],
+                "max_distance": max_distance
+            })
+            inserted = cur.rowcount
+            cur.execute(
+                """
+                UPDATE match_tiles SET state = 'done', lease_owner = NULL, lease_expires_at = NULL
+                WHERE hashing_method_id = %s AND row_start = %s AND col_start = %s
+                """,
+                (method_id, *checkpoint)
+            )
+
+        return inserted
+
+    def count_hashes_per_method(self)->dict[int, int]:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT hashing_method_id, COUNT(*) FROM hashes GROUP BY hashing_method_id")
+            return {method_id: int(count) for method_id, count in cur.fetchall()}
+
+    def get_run_pairs(self, method_id:int)->tuple[int, int]:
+        """
+        Pairs in done tiles and pairs in all tiles of the run of a hashing method
+        """
+        command = """
+        SELECT COALESCE(SUM(pairs) FILTER (WHERE state = 'done'), 0), COALESCE(SUM(pairs), 0)
+        FROM match_tiles WHERE hashing_method_id = %s
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (method_id,))
+            result = cur.fetchone()
+
+        return (int(result[0]), int(result[1])) if result else (0, 0)
+
+    def count_hashes(self, method_id:int, max_id:int)->int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM hashes WHERE hashing_method_id = %s AND id <= %s", (method_id, max_id))
+            result = cur.fetchone()
+
+        return int(result[0]) if result else 0
+
+    def lock_match_run(self, method_id:int):
+        """
+        Serializes starting a run of the hashing method between matcher replicas until the transaction ends
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (method_id,))
+
+    def start_match_run(self, run:MatchRun, tiles:list[tuple[int, int, int]]):
+        """
+        Replaces the run of the hashing method, dropping the tiles of the previous one.
+        Histograms of the method are dropped if the new run counts them again, or the previous run left them incomplete,
+        so a later threshold run keeps the histograms of a finished histogram run.
+        tiles: (row_start, col_start, pairs) of every tile in the run
+        Also creates the matches partition of the hashing method if it is missing.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(
+                sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF matches FOR VALUES IN ({})").format(
+                    sql.Identifier(f"matches_method_{run.hashing_method_id}"), sql.Literal(run.hashing_method_id)
+                )
+            )
+            cur.execute("DELETE FROM match_runs WHERE hashing_method_id = %s RETURNING histogram, done", (run.hashing_method_id,))
+            previous = cur.fetchone()
+            if run.histogram or (previous is not None and previous[0] and not previous[1]):
+                cur.execute("DELETE FROM match_histograms WHERE hashing_method_id = %s", (run.hashing_method_id,))
+            cur.execute(
+                "INSERT INTO match_runs (hashing_method_id, engine, block_size, max_distance, max_hash_id, done, histogram) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (run.hashing_method_id, run.engine, run.block_size, run.max_distance, run.max_hash_id, run.done, run.histogram)
+            )
+            execute_values(
+                cur,
+                "INSERT INTO match_tiles (hashing_method_id, row_start, col_start, pairs) VALUES %s",
+                [(run.hashing_method_id, row, col, pairs) for row, col, pairs in tiles],
+                page_size=1000
+            )
+
+    def lease_tiles(self, method_id:int, owner:str, amount:int, lease_seconds:int)->list[tuple[int, int]]:
+        """
+        Leases up to amount pending tiles, or tiles whose lease expired. Returns (row_start, col_start) of each.
+        Tiles locked by other replicas are skipped instead of waited on.
+        """
+        command = """
+        UPDATE match_tiles t
+        SET state = 'leased', lease_owner = %s, lease_expires_at = now() + make_interval(secs => %s)
+        FROM (
+          SELECT hashing_method_id, row_start, col_start
+          FROM match_tiles
+          WHERE hashing_method_id = %s AND (state = 'pending' OR (state = 'leased' AND lease_expires_at < now()))
+          ORDER BY row_start, col_start
+          LIMIT %s
+          FOR UPDATE SKIP LOCKED
+        ) free
+        WHERE t.hashing_method_id = free.hashing_method_id AND t.row_start = free.row_start AND t.col_start = free.col_start
+        RETURNING t.row_start, t.col_start
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (owner, lease_seconds, method_id, amount))
+            return [(row, col) for row, col in cur.fetchall()]
+
+    def release_tiles(self, method_id:int, owner:str):
+        """
+        Returns the tiles leased by owner that are not done to pending, so other replicas can take them right away
+        """
+        command = """
+        UPDATE match_tiles SET state = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        WHERE hashing_method_id = %s AND lease_owner = %s AND state = 'leased'
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (method_id, owner))
+
+    def finish_match_run(self, method_id:int)->bool:
+        """
+        Marks the run as done if every tile is done. Returns False while other replicas still hold tiles.
+        """
+        command = """
+        UPDATE match_runs SET done = TRUE
+        WHERE hashing_method_id = %s
+        AND NOT EXISTS (SELECT 1 FROM match_tiles WHERE hashing_method_id = %s AND state <> 'done')
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (method_id, method_id))
+            return cur.rowcount > 0
+
+    def get_match_progress(self)->list[MatchRunProgress]:
+        """
+        Progress of every run, summed over all matcher replicas
+        """
+        command = """
+        SELECT r.hashing_method_id, r.done,
+          COUNT(*) FILTER (WHERE t.state = 'pending'),
+          COUNT(*) FILTER (WHERE t.state = 'leased'),
+          COUNT(*) FILTER (WHERE t.state = 'done'),
+          COALESCE(SUM(t.pairs) FILTER (WHERE t.state = 'done'), 0),
+          COALESCE(SUM(t.pairs), 0)
+        FROM match_runs r
+        LEFT JOIN match_tiles t ON t.hashing_method_id = r.hashing_method_id
+        GROUP BY r.hashing_method_id, r.done
+        ORDER BY r.hashing_method_id
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command)
+            return [MatchRunProgress(*row) for row in cur.fetchall()]
+
+    def get_match_histograms(self, method_id:int)->list[tuple[int, int, bool, bool, int, int]]:
+        """
+        (modification_id1, modification_id2, same_image, same_user, hamming_distance, pairs) of a hashing method
+        """
+        command = """
+        SELECT modification_id1, modification_id2, same_image, same_user, hamming_distance, pairs
+        FROM match_histograms
+        WHERE hashing_method_id = %s
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command, (method_id,))
+            return [(mod1, mod2, same_image, same_user, distance, int(pairs)) for mod1, mod2, same_image, same_user, distance, pairs in cur.fetchall()]
+
+    def get_histogram_methods(self)->list[tuple[int, int]]:
+        """
+        (hashing_method_id, hash_bits) of every hashing method with histograms
+        """
+        command = """
+        SELECT m.id, (SELECT MAX(h.hash_bits) FROM hashes h WHERE h.hashing_method_id = m.id)
+        FROM hashing_methods m
+        WHERE EXISTS (SELECT 1 FROM match_histograms mh WHERE mh.hashing_method_id = m.id)
+        ORDER BY m.id
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(command)
+            return [(method_id, bits) for method_id, bits in cur.fetchall()]
+
+    def save_evaluations(self, evaluations:list["Evaluation"]):
+        """
+        Replaces the stored evaluations with the same hashing method, modification and label
+        """
+        command = """
+        INSERT INTO match_evaluations (hashing_method_id, modification_id, label, genuine_pairs, impostor_pairs, tpr, fpr,
+          eer, eer_threshold, best_threshold, best_tpr, best_fpr)
+        VALUES %s
+        ON CONFLICT ON CONSTRAINT unique_match_evaluations DO UPDATE SET
+          genuine_pairs = EXCLUDED.genuine_pairs, impostor_pairs = EXCLUDED.impostor_pairs, tpr = EXCLUDED.tpr, fpr = EXCLUDED.fpr,
+          eer = EXCLUDED.eer, eer_threshold = EXCLUDED.eer_threshold, best_threshold = EXCLUDED.best_threshold,
+          best_tpr = EXCLUDED.best_tpr, best_fpr = EXCLUDED.best_fpr, created_at = now()
+        """
+        with self.conn.cursor() as cur:
+            execute_values(cur, command, [
+                (e.hashing_method_id, e.modification_id, e.label.value, e.genuine_pairs, e.impostor_pairs, e.tpr, e.fpr,
+                 e.eer, e.eer_threshold, e.best_threshold, e.best_tpr, e.best_fpr)
+                for e in evaluations
+            ])
+
     def get_max_id(self)->int:
         if self.max_id is not None:
             return self.max_id
@@ -129,3 +426,154 @@ class Database(ContextDecorator):
         else:
             self.conn.rollback()
         self.conn.close()
+
+@dataclass
+class MatchBatch:
+    """
+    Matches, tile checkpoints and histogram counts committed together by MatchWriter. histograms: Counts of each checkpointed tile
+    """
+    chunks:list[tuple[int, Sequence[int], Sequence[int], Sequence[int]]]
+    pending:int
+    checkpoints:list[tuple[int, int, int]]
+    histograms:dict[tuple[int, int, int], "DistanceHistogram"]
+
+class MatchWriter:
+    """
+    Buffers matches in memory and bulk loads them with COPY into a temporary staging table,
+    which is then merged into matches with a single INSERT ... SELECT.
+    Duplicates are skipped by the unique_matches constraint, same as add_hamming_distance.
+    A flush is due when flush_rows are buffered or flush_interval seconds have passed since the last one.
+    Tile checkpoints are committed in the same transaction as the matches and histogram counts of the tile.
+    A tile is only marked done while leased by owner, and its histogram counts are only added if this marked it done,
+    so a tile compared again after its lease expired is not counted twice. Its matches are skipped as duplicates.
+    Batches are written on a dedicated thread with its own connection, so the matcher keeps comparing
+    and the event loop stays free while a batch is written. At most one batch is written while the next is buffered.
+    """
+    def __init__(self, database:Database, owner:str, flush_rows:int, flush_interval:float) -> None:
+        """
+        database: Connection only used by the writer thread
+        owner: Matcher leasing the checkpointed tiles
+        """
+        self.database = database
+        self.owner = owner
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+
+        self.batch = MatchBatch([], 0, [], {})
+        self.written = 0
+        self.last_flush = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="match-writer")
+        self.writing:asyncio.Future[int] | None = None
+        self._staging_created = False
+
+    def add(self, method_id:int, hamming_distances:Sequence[int], hash_ids1:Sequence[int], hash_ids2:Sequence[int], checkpoint:tuple[int, int, int] | None = None, histogram:"DistanceHistogram | None" = None)->bool:
+        """
+        checkpoint: (hashing_method_id, row_start, col_start) of the tile these matches complete
+        histogram: Distance counts of the tile, added to match_histograms when the checkpoint is written. Needs checkpoint
+        Returns True when a flush is due
+        """
+        if histogram is not None and checkpoint is None:
+            raise ValueError("Histogram counts are written with the checkpoint of their tile")
+
+        self.batch.chunks.append((method_id, hamming_distances, hash_ids1, hash_ids2))
+        self.batch.pending += len(hamming_distances)
+        if checkpoint is not None:
+            self.batch.checkpoints.append(checkpoint)
+        if checkpoint is not None and histogram is not None:
+            self.batch.histograms[checkpoint] = histogram
+
+        return self.batch.pending >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval
+
+    async def flush(self, wait:bool = False):
+        """
+        Hands the buffered matches to the writer thread, after the previous batch is written.
+        wait: Also wait until this batch is committed
+        Errors of a batch are raised by the next flush.
+        """
+        if self.writing is not None:
+            writing, self.writing = self.writing, None
+            await writing
+
+        self.last_flush = time.monotonic()
+        batch, self.batch = self.batch, MatchBatch([], 0, [], {})
+        if batch.pending or batch.checkpoints:
+            self.writing = asyncio.get_running_loop().run_in_executor(self.executor, self._write, batch)
+
+        if wait and self.writing is not None:
+            writing, self.writing = self.writing, None
+            await writing
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self, batch:MatchBatch)->int:
+        """
+        Writes and commits a batch. Returns the amount of new rows in matches
+        """
+        buffer = io.StringIO()
+        for method_id, hamming_distances, hash_ids1, hash_ids2 in batch.chunks:
+            buffer.write("".join(f"{method_id}\t{hd}\t{id1}\t{id2}\n" for hd, id1, id2 in zip(hamming_distances, hash_ids1, hash_ids2)))
+
+        with self.database.conn.cursor() as cur:
+            histogram:"DistanceHistogram | None" = None
+            for checkpoint in batch.checkpoints:
+                cur.execute(
+                    """
+                    UPDATE match_tiles SET state = 'done', lease_owner = NULL, lease_expires_at = NULL
+                    WHERE hashing_method_id = %s AND row_start = %s AND col_start = %s AND state <> 'done' AND lease_owner = %s
+                    """,
+                    (*checkpoint, self.owner)
+                )
+                if cur.rowcount == 0:
+                    logging.info(f"Tile {checkpoint} was done or leased by another matcher, not counting it")
+                    continue
+
+                tile_histogram = batch.histograms.get(checkpoint)
+                if tile_histogram is not None:
+                    histogram = tile_histogram if histogram is None else histogram.merge(tile_histogram)
+
+            if histogram is not None:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO match_histograms (hashing_method_id, modification_id1, modification_id2, same_image, same_user, hamming_distance, pairs)
+                    VALUES %s
+                    ON CONFLICT ON CONSTRAINT match_histograms_pkey DO UPDATE SET pairs = match_histograms.pairs + EXCLUDED.pairs
+                    """,
+                    [(histogram.hashing_method_id, *row) for row in histogram.rows()],
+                    page_size=1000
+                )
+
+            if not self._staging_created:
+                cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS matches_staging (
+                  hashing_method_id INTEGER NOT NULL,
+                  hamming_distance SMALLINT NOT NULL,
+                  hash_id1 INTEGER NOT NULL,
+                  hash_id2 INTEGER NOT NULL
+                ) ON COMMIT DELETE ROWS
+                """)
+                self._staging_created = True
+
+            buffer.seek(0)
+            cur.copy_expert("COPY matches_staging (hashing_method_id, hamming_distance, hash_id1, hash_id2) FROM STDIN", buffer)
+            cur.execute("""
+            INSERT INTO matches (hashing_method_id, hamming_distance, hash_id1, hash_id2)
+            SELECT hashing_method_id, hamming_distance, hash_id1, hash_id2 FROM matches_staging
+            ON CONFLICT ON CONSTRAINT unique_matches DO NOTHING
+            """)
+            inserted = cur.rowcount
+
+        self.database.commit()
+
+        if inserted < batch.pending:
+            logging.info(f"Skipped {batch.pending - inserted} matches that already exists")
+
+        self.written += inserted
+        return inserted
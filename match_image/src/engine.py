@@ -0,0 +1,415 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Self
+from itertools import combinations
+import math
+import numpy as np
+from src import db
+
+DEFAULT_BLOCK_SIZE = 256
+PROBE_COST = 20 # Rough cost of one multi-index bucket probe, relative to one vectorized brute force comparison
+DATABASE_ENGINE = "sql" # Matching inside Postgres, see DatabaseMatching. Not a registered MatchEngine, as it compares nothing in the matcher
+
+@dataclass
+class UnknownEngineError(Exception):
+    name:str
+    def __str__(self) -> str:
+        return f"Match engine {self.name} is not registered"
+
+@dataclass
+class HashMatrix:
+    """
+    All hashes of one hashing method packed into rows of big-endian uint64 words, sorted by id.
+    """
+    ids: np.ndarray
+    words: np.ndarray
+    bits: int
+    hashing_method_id: int | None = None
+    modification_ids: np.ndarray | None = None # Distinct modification ids, modifications indexes into it
+    modifications: np.ndarray | None = None
+    image_ids: np.ndarray | None = None
+    user_ids: np.ndarray | None = None # -1 for images without user
+
+    @classmethod
+    def from_hashes(cls, hashes:list[db.Hash])->Self:
+        if not hashes:
+            return cls(np.empty(0, dtype=np.int64), np.empty((0, 1), dtype=np.uint64), 0)
+
+        bits, size = hashes[0].bits, len(hashes[0].hash)
+        if any(h.bits != bits or len(h.hash) != size for h in hashes):
+            raise ValueError("Hashes must have the same length")
+
+        raw = np.frombuffer(b"".join(h.hash for h in hashes), dtype=np.uint8).reshape(len(hashes), size)
+        width = -(-bits // 64) * 64 # Pad to whole 64 bit words, keeping the hash bits rightmost
+        padded = np.zeros((len(hashes), width), dtype=np.uint8)
+        padded[:, width - bits:] = np.unpackbits(raw, axis=1, count=bits)
+        words = np.packbits(padded, axis=1).view(">u8").astype(np.uint64)
+        ids = np.fromiter((h.id for h in hashes), dtype=np.int64, count=len(hashes))
+
+        order = np.argsort(ids, kind="stable")
+        modification_ids, modifications = np.unique(column(hashes, "modification_id"), return_inverse=True)
+        return cls(
+            ids[order], words[order], bits, hashes[0].hash_method_id, modification_ids, modifications[order],
+            column(hashes, "image_id")[order], column(hashes, "user_id")[order]
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+@dataclass(frozen=True)
+class Tile:
+    """
+    Rectangle of the pair matrix, given as row and column index ranges into a HashMatrix.
+    Only pairs on or above the diagonal (row <= col) belong to a tile.
+    """
+    row_start:int
+    row_stop:int
+    col_start:int
+    col_stop:int
+
+    @property
+    def pairs(self)->int:
+        rows = np.arange(self.row_start, self.row_stop)
+        return int(np.clip(self.col_stop - np.maximum(self.col_start, rows), 0, None).sum())
+
+    def split(self, size:int)->list[Self]:
+        """
+        Splits the tile into tiles of at most size x size, skipping those entirely below the diagonal
+        """
+        return [
+            Tile(row, min(row + size, self.row_stop), col, min(col + size, self.col_stop))
+            for row in range(self.row_start, self.row_stop, size)
+            for col in range(max(self.col_start, row), self.col_stop, size)
+        ]
+
+def column(hashes:list[db.Hash], name:str)->np.ndarray:
+    """
+    One attribute of every hash as an int64 array, -1 where it is None
+    """
+    return np.fromiter((-1 if (value := getattr(h, name)) is None else value for h in hashes), dtype=np.int64, count=len(hashes))
+
+@dataclass
+class DistanceHistogram:
+    """
+    Sparse counts of pairs per (modification 1, modification 2, same image, same user, distance in bits).
+    keys encode the buckets, see from_pairs. The modifications of a pair are ordered so modification 1 <= modification 2.
+    """
+    hashing_method_id: int | None
+    modification_ids: np.ndarray
+    bits: int
+    keys: np.ndarray
+    counts: np.ndarray
+
+    @classmethod
+    def from_pairs(cls, matrix:HashMatrix, rows:np.ndarray, cols:np.ndarray, distance:np.ndarray)->Self:
+        """
+        rows, cols: Positions of the hashes of each pair in the matrix
+        """
+        assert matrix.modification_ids is not None and matrix.modifications is not None
+        assert matrix.image_ids is not None and matrix.user_ids is not None
+        m = len(matrix.modification_ids)
+        mod1, mod2 = matrix.modifications[rows], matrix.modifications[cols]
+        same_image = matrix.image_ids[rows] == matrix.image_ids[cols]
+        same_user = (matrix.user_ids[rows] == matrix.user_ids[cols]) & (matrix.user_ids[rows] >= 0)
+
+        keys = ((np.minimum(mod1, mod2) * m + np.maximum(mod1, mod2)) * 4 + same_image * 2 + same_user) * (matrix.bits + 1) + distance
+        keys, counts = np.unique(keys, return_counts=True)
+        return cls(matrix.hashing_method_id, matrix.modification_ids, matrix.bits, keys, counts)
+
+    def merge(self, other:Self)->Self:
+        keys, inverse = np.unique(np.concatenate([self.keys, other.keys]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([self.counts, other.counts])).astype(np.int64)
+        return type(self)(self.hashing_method_id, self.modification_ids, self.bits, keys, counts)
+
+    def rows(self)->list[tuple[int, int, bool, bool, int, int]]:
+        """
+        (modification_id1, modification_id2, same_image, same_user, hamming_distance, pairs) of every bucket with pairs
+        """
+        m = len(self.modification_ids)
+        rest, distance = np.divmod(self.keys, self.bits + 1)
+        rest, flags = np.divmod(rest, 4)
+        mod1, mod2 = np.divmod(rest, m)
+        return list(zip(
+            self.modification_ids[mod1].tolist(), self.modification_ids[mod2].tolist(),
+            (flags >= 2).tolist(), (flags % 2 == 1).tolist(), distance.tolist(), self.counts.tolist()
+        ))
+
+@dataclass
+class DistanceBlock:
+    """
+    Distances for a set of pairs. `distance` is the number of differing bits.
+    """
+    hash_id1: np.ndarray
+    hash_id2: np.ndarray
+    distance: np.ndarray
+    bits: int
+    histogram: DistanceHistogram | None = None
+
+    def __len__(self) -> int:
+        return len(self.distance)
+
+    def hamming_distances(self)->np.ndarray:
+        """
+        Distances normalized by hash length, same as the matches_normalized view
+        """
+        return self.distance / self.bits
+
+    @classmethod
+    def concat(cls, blocks:list[Self], bits:int)->Self:
+        if not blocks:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint16), bits)
+
+        return cls(
+            np.concatenate([b.hash_id1 for b in blocks]),
+            np.concatenate([b.hash_id2 for b in blocks]),
+            np.concatenate([b.distance for b in blocks]),
+            bits
+        )
+
+class MatchEngine(ABC):
+    def __init__(self, block_size:int = DEFAULT_BLOCK_SIZE, max_distance:float | None = None) -> None:
+        """
+        max_distance: Only pairs with a normalized hamming distance at or below this are returned. None returns every pair.
+        """
+        self.block_size = block_size
+        self.max_distance = max_distance
+
+    def radius(self, bits:int)->int | None:
+        """
+        max_distance as an amount of bits for hashes of the given length
+        """
+        if self.max_distance is None:
+            return None
+        return math.floor(self.max_distance * bits + 1e-9)
+
+    @abstractmethod
+    def tiles(self, n:int)->list[Tile]:
+        """
+        Splits the upper triangle of an n x n pair matrix into tiles that can be compared independently.
+        """
+        pass
+
+    @abstractmethod
+    def compare(self, matrix:HashMatrix, tile:Tile)->DistanceBlock:
+        pass
+
+class MatchEngines:
+    match_engines:dict[str, type[MatchEngine]] = {}
+
+    @classmethod
+    def register(cls, name:str):
+        def decorator(engine_cls:type[MatchEngine]):
+            cls.match_engines.update({name:engine_cls})
+            return engine_cls
+        return decorator
+
+    @classmethod
+    def get(cls, name:str)->type[MatchEngine]:
+        try:
+            return cls.match_engines[name]
+        except KeyError:
+            raise UnknownEngineError(name)
+
+@MatchEngines.register(name="numpy")
+class NumpyEngine(MatchEngine):
+    """
+    Brute force all-pairs comparison. Each tile is block_size x block_size so the XOR intermediate stays in cache.
+    """
+    def tiles(self, n:int)->list[Tile]:
+        return Tile(0, n, 0, n).split(self.block_size)
+
+    def compare(self, matrix:HashMatrix, tile:Tile)->DistanceBlock:
+        dist = bit_distances(matrix.words[tile.row_start:tile.row_stop], matrix.words[tile.col_start:tile.col_stop])
+
+        rows = np.arange(tile.row_start, tile.row_stop)
+        cols = np.arange(tile.col_start, tile.col_stop)
+        keep = cols[None, :] >= rows[:, None]
+
+        radius = self.radius(matrix.bits)
+        if radius is not None:
+            keep &= dist <= radius
+
+        r, c = np.nonzero(keep)
+
+        return DistanceBlock(matrix.ids[rows[r]], matrix.ids[cols[c]], dist[r, c], matrix.bits)
+
+class DatabaseMatching:
+    """
+    Set based matching inside Postgres. Each tile is one INSERT INTO matches ... SELECT self-join on bit_count,
+    see db.Database.match_tile, so no pairs are sent over the wire. Only splits the pairs into tiles, which the matcher
+    hands to the database instead of a MatchEngine. Tiles are block_size x block_size to bound each transaction.
+    """
+    def __init__(self, block_size:int = DEFAULT_BLOCK_SIZE, max_distance:float | None = None) -> None:
+        self.block_size = block_size
+        self.max_distance = max_distance
+
+    def tiles(self, n:int)->list[Tile]:
+        return Tile(0, n, 0, n).split(self.block_size)
+
+class HistogramEngine(MatchEngine):
+    """
+    Wraps an engine that returns every pair, counting all of them in a DistanceHistogram attached to the block.
+    Only pairs at or below max_distance are kept in the block, none if it is None.
+    """
+    def __init__(self, match_engine:MatchEngine, max_distance:float | None = None) -> None:
+        if match_engine.max_distance is not None:
+            raise ValueError("Histograms need an engine that compares every pair in the matcher")
+        super().__init__(match_engine.block_size, max_distance)
+        self.match_engine = match_engine
+
+    def tiles(self, n:int)->list[Tile]:
+        return self.match_engine.tiles(n)
+
+    def compare(self, matrix:HashMatrix, tile:Tile)->DistanceBlock:
+        block = self.match_engine.compare(matrix, tile)
+        rows = np.searchsorted(matrix.ids, block.hash_id1)
+        cols = np.searchsorted(matrix.ids, block.hash_id2)
+        histogram = DistanceHistogram.from_pairs(matrix, rows, cols, block.distance)
+
+        radius = self.radius(matrix.bits)
+        keep = block.distance <= radius if radius is not None else np.zeros(len(block), dtype=bool)
+        return DistanceBlock(block.hash_id1[keep], block.hash_id2[keep], block.distance[keep], block.bits, histogram)
+
+@dataclass
+class SubstringIndex:
+    """
+    One substring (chunk) of the hashes. keys holds the chunk value of every hash, sorted_keys and order allow range lookups.
+    masks are every chunk value with at most `radius` bits set, used to probe neighbouring buckets.
+    """
+    keys: np.ndarray
+    sorted_keys: np.ndarray
+    order: np.ndarray
+    masks: np.ndarray
+    radius: int
+
+@MatchEngines.register(name="mih")
+class MultiIndexEngine(MatchEngine):
+    """
+    Threshold matching with multi-index hashing (Norouzi et al.).
+    The hash is split into m disjoint substrings. If two hashes are within r bits, at least one
+    substring is within floor(r/m) bits, so only pairs sharing a close substring are verified.
+    Each tile is a block of query rows matched against every hash at or after it.
+    When the radius is so large that probing costs more than comparing everything, tiles are brute forced instead.
+    """
+    def __init__(self, block_size:int = DEFAULT_BLOCK_SIZE, max_distance:float | None = None) -> None:
+        if max_distance is None:
+            raise ValueError("The mih engine requires max_distance")
+        super().__init__(block_size, max_distance)
+        self._index:list[SubstringIndex] = []
+        self._indexed:HashMatrix | None = None
+        self._scan:NumpyEngine | None = None
+
+    def tiles(self, n:int)->list[Tile]:
+        return [Tile(row, min(row + self.block_size, n), row, n) for row in range(0, n, self.block_size)]
+
+    def compare(self, matrix:HashMatrix, tile:Tile)->DistanceBlock:
+        radius = self.radius(matrix.bits)
+        assert radius is not None
+
+        if self._indexed is not matrix:
+            self._index = build_index(matrix, radius)
+            self._indexed = matrix
+            if self._index and PROBE_COST * lookup_cost(len(matrix), matrix.bits, radius, len(self._index)) > len(matrix):
+                self._scan = NumpyEngine(DEFAULT_BLOCK_SIZE, self.max_distance)
+            else:
+                self._scan = None
+
+        if self._scan is not None:
+            return DistanceBlock.concat([self._scan.compare(matrix, sub) for sub in tile.split(self._scan.block_size)], matrix.bits)
+
+        queries = np.arange(tile.row_start, tile.row_stop)
+        rows_found:list[np.ndarray] = []
+        cols_found:list[np.ndarray] = []
+        for c, chunk in enumerate(self._index):
+            query_keys = chunk.keys[queries]
+            for mask in chunk.masks:
+                probe = query_keys ^ mask
+                lo = np.searchsorted(chunk.sorted_keys, probe, side="left")
+                counts = np.searchsorted(chunk.sorted_keys, probe, side="right") - lo
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+
+                rows = np.repeat(queries, counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                cols = chunk.order[np.repeat(lo, counts) + offsets]
+
+                keep = (cols >= rows) & (cols >= tile.col_start) & (cols < tile.col_stop)
+                # A pair is only reported by the first substring that finds it
+                for prev in self._index[:c]:
+                    keep &= np.bitwise_count(prev.keys[rows] ^ prev.keys[cols]) > prev.radius
+
+                rows_found.append(rows[keep])
+                cols_found.append(cols[keep])
+
+        rows = np.concatenate(rows_found) if rows_found else np.empty(0, dtype=np.int64)
+        cols = np.concatenate(cols_found) if cols_found else np.empty(0, dtype=np.int64)
+
+        dist = np.bitwise_count(matrix.words[rows] ^ matrix.words[cols]).sum(axis=1, dtype=np.uint16)
+        keep = dist <= radius
+
+        return DistanceBlock(matrix.ids[rows[keep]], matrix.ids[cols[keep]], dist[keep], matrix.bits)
+
+def build_index(matrix:HashMatrix, radius:int)->list[SubstringIndex]:
+    """
+    Splits the hashes into the amount of substrings with the lowest estimated cost, see lookup_cost.
+    """
+    n, bits = len(matrix), matrix.bits
+    if n == 0:
+        return []
+
+    min_chunks = -(-bits // 64) # Substring keys must fit in an uint64
+    chunk_count = min(range(min_chunks, max(min_chunks, min(radius + 1, bits)) + 1), key=lambda m: lookup_cost(n, bits, radius, m))
+    sub_radius = radius // chunk_count
+
+    raw = matrix.words.astype(">u8").view(np.uint8).reshape(n, -1)
+    hash_bits = np.unpackbits(raw, axis=1)[:, -bits:]
+
+    index = []
+    for chunk in np.array_split(hash_bits, chunk_count, axis=1):
+        width = chunk.shape[1]
+        shifts = np.arange(width - 1, -1, -1, dtype=np.uint64)
+        keys = np.bitwise_or.reduce(chunk.astype(np.uint64) << shifts, axis=1)
+        order = np.argsort(keys, kind="stable")
+        masks = np.array(
+            [sum(1 << p for p in flipped) for weight in range(sub_radius + 1) for flipped in combinations(range(width), weight)],
+            dtype=np.uint64
+        )
+        index.append(SubstringIndex(keys, keys[order], order, masks, sub_radius))
+
+    return index
+
+def probe_count(width:int, radius:int)->int:
+    """
+    Amount of buckets within radius of a key of the given width
+    """
+    return sum(math.comb(width, weight) for weight in range(radius + 1))
+
+def lookup_cost(n:int, bits:int, radius:int, chunk_count:int)->float:
+    """
+    Estimated work per query hash: every substring probes all buckets within radius // chunk_count,
+    and every probe returns on average n / 2^width candidates that have to be verified.
+    """
+    width = -(-bits // chunk_count)
+    return chunk_count * probe_count(width, radius // chunk_count) * (1 + n / 2 ** width)
+
+_worker_engine:MatchEngine | None = None
+_worker_matrix:HashMatrix | None = None
+
+def init_worker(match_engine:MatchEngine, matrix:HashMatrix):
+    """
+    Process pool initializer. The matrix is sent once per worker instead of with every tile.
+    """
+    global _worker_engine, _worker_matrix
+    _worker_engine = match_engine
+    _worker_matrix = matrix
+
+def compare_in_worker(tile:Tile)->tuple[Tile, DistanceBlock]:
+    assert _worker_engine is not None and _worker_matrix is not None
+    return tile, _worker_engine.compare(_worker_matrix, tile)
+
+def bit_distances(a:np.ndarray, b:np.ndarray)->np.ndarray:
+    """
+    Number of differing bits between every row of a and every row of b, shape (len(a), len(b))
+    """
+    return np.bitwise_count(a[:, None, :] ^ b[None, :, :]).sum(axis=2, dtype=np.uint16)
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterable
+import numpy as np
+
+class Label(str, Enum):
+    """
+    What makes a pair genuine, meaning a hashing method should match it
+    """
+    IMAGE = "image" # Both hashes are of the same source image
+    USER = "user" # Both hashes are of images of the same user
+
+@dataclass
+class Evaluation:
+    """
+    Detection rates of a hashing method when pairs at or below a threshold (in bits) count as matches.
+    tpr and fpr are the ROC curve, indexed by threshold. modification_id is None for all modifications together.
+    The EER is taken at the threshold where the false non-match rate is closest to the false match rate,
+    the best threshold is the one with the highest tpr - fpr.
+    """
+    hashing_method_id:int
+    modification_id:int | None
+    label:Label
+    genuine_pairs:int
+    impostor_pairs:int
+    tpr:list[float]
+    fpr:list[float]
+    eer:float
+    eer_threshold:int
+    best_threshold:int
+    best_tpr:float
+    best_fpr:float
+
+def evaluate(hashing_method_id:int, modification_id:int | None, label:Label, genuine:np.ndarray, impostor:np.ndarray)->Evaluation | None:
+    """
+    genuine, impostor: Pair counts per distance in bits. Returns None if either has no pairs.
+    """
+    genuine_pairs, impostor_pairs = int(genuine.sum()), int(impostor.sum())
+    if genuine_pairs == 0 or impostor_pairs == 0:
+        return None
+
+    tpr = np.cumsum(genuine) / genuine_pairs
+    fpr = np.cumsum(impostor) / impostor_pairs
+
+    eer_threshold = int(np.argmin(np.abs((1 - tpr) - fpr)))
+    best_threshold = int(np.argmax(tpr - fpr))
+
+    return Evaluation(
+        hashing_method_id, modification_id, label, genuine_pairs, impostor_pairs, tpr.tolist(), fpr.tolist(),
+        float((1 - tpr[eer_threshold] + fpr[eer_threshold]) / 2), eer_threshold,
+        best_threshold, float(tpr[best_threshold]), float(fpr[best_threshold])
+    )
+
+def evaluate_histograms(hashing_method_id:int, bits:int, rows:Iterable[tuple[int, int, bool, bool, int, int]], label:Label = Label.IMAGE)->list[Evaluation]:
+    """
+    Evaluates a hashing method from its match_histograms rows (modification_id1, modification_id2, same_image, same_user, hamming_distance, pairs),
+    once for all modifications and once per modification, counting the pairs with a hash of that modification.
+    Buckets of the same image and modification only hold the pairs of a hash with itself, so they are skipped.
+    """
+    genuine:dict[int | None, np.ndarray] = {}
+    impostor:dict[int | None, np.ndarray] = {}
+    for mod1, mod2, same_image, same_user, distance, pairs in rows:
+        if same_image and mod1 == mod2:
+            continue
+
+        counts = genuine if (same_image if label == Label.IMAGE else same_user) else impostor
+        for modification_id in {None, mod1, mod2}:
+            counts.setdefault(modification_id, np.zeros(bits + 1, dtype=np.int64))[distance] += pairs
+
+    evaluations = []
+    for modification_id in sorted(genuine.keys() | impostor.keys(), key=lambda m: -1 if m is None else m):
+        empty = np.zeros(bits + 1, dtype=np.int64)
+        evaluation = evaluate(hashing_method_id, modification_id, label, genuine.get(modification_id, empty), impostor.get(modification_id, empty))
+        if evaluation is not None:
+            evaluations.append(evaluation)
+
+    return evaluations
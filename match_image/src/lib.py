@@ -1,9 +1,18 @@
+from typing import AsyncGenerator, AsyncIterator, Generator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from collections import deque
 from dataclasses import dataclass
-from typing import Generator 
+from enum import Enum
 from src import db
+from src import engine
+from src import evaluation
+from src import config as cf
 import asyncio
+import multiprocessing
 import psycopg2
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -12,43 +21,390 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
 )
 
+CONFIG = cf.Config.from_env()
+
+LOAD_BATCH_SIZE = 10_000
+SHORT_RATE_WINDOW = 10 # Seconds
+LONG_RATE_WINDOW = 60
+LEASE_POLL_SECONDS = 10 # Between lease attempts while the rest of the tiles are leased by other matchers
+
+class MatchPhase(str, Enum):
+    IDLE = "idle"
+    LOADING = "loading"
+    COMPARING = "comparing"
+    FLUSHING = "flushing"
+    PAUSED = "paused"
+    WAITING = "waiting" # For tiles leased by other matchers
+    STOPPED = "stopped"
+    DONE = "done"
+
 @dataclass
-class Match:
-    id: int
-    hamming_distance: float
-    hash_id1: int
-    hash_id2: int
-    
+class MatchReport:
+    """
+    pairs_total and pairs_done are of the current run, counting the tiles of every matcher replica done before this one joined.
+    pairs_compared and rows_written are of this matcher over all hashing methods.
+    expected_pairs: Pairs of every hashing method with hashes, hashing method id -> pairs
+    """
+    phase:MatchPhase
+    hashing_method_id:int | None
+    pairs_total:int
+    pairs_done:int
+    pairs_compared:int
+    rows_written:int
+    pairs_per_second_short:float
+    pairs_per_second_long:float
+    rows_per_second_short:float
+    rows_per_second_long:float
+    eta_seconds:float | None
+    expected_pairs:dict[int, int]
+
+class MatchProgress:
+    """
+    Progress of one matcher, updated once per tile. Rates over SHORT_RATE_WINDOW and LONG_RATE_WINDOW
+    are computed from the per tile samples when a report is made.
+    """
+    def __init__(self) -> None:
+        self.phase = MatchPhase.IDLE
+        self.hashing_method_id:int | None = None
+        self.pairs_total = 0
+        self.pairs_done = 0
+        self.pairs_compared = 0
+        self.rows_written = 0
+        self.expected_pairs:dict[int, int] = {}
+        self.samples:deque[tuple[float, int, int]] = deque() # (time, pairs_compared, rows_written)
+
+    def start_run(self, method_id:int, pairs_total:int, pairs_done:int):
+        self.hashing_method_id = method_id
+        self.pairs_total = pairs_total
+        self.pairs_done = pairs_done
+
+    def add(self, pairs:int, rows_written:int):
+        """
+        rows_written: Rows written by this matcher so far
+        """
+        self.pairs_compared += pairs
+        self.pairs_done += pairs
+        self.rows_written = rows_written
+
+        now = time.monotonic()
+        self.samples.append((now, self.pairs_compared, self.rows_written))
+        while self.samples[0][0] < now - LONG_RATE_WINDOW:
+            self.samples.popleft()
+
+    def rates(self, window:float)->tuple[float, float]:
+        """
+        Pairs and rows per second over the last window seconds
+        """
+        now = time.monotonic()
+        start = next((sample for sample in self.samples if sample[0] >= now - window), None)
+        if start is None:
+            return 0.0, 0.0
+
+        elapsed = max(now - start[0], 1e-3)
+        _, pairs, rows = self.samples[-1]
+        return (pairs - start[1]) / elapsed, (rows - start[2]) / elapsed
+
+    def report(self)->MatchReport:
+        pairs_short, rows_short = self.rates(SHORT_RATE_WINDOW)
+        pairs_long, rows_long = self.rates(LONG_RATE_WINDOW)
+        remaining = max(self.pairs_total - self.pairs_done, 0)
+        eta = remaining / pairs_short if pairs_short > 0 else None
+
+        return MatchReport(
+            self.phase, self.hashing_method_id, self.pairs_total, self.pairs_done, self.pairs_compared, self.rows_written,
+            pairs_short, pairs_long, rows_short, rows_long, eta, dict(self.expected_pairs)
+        )
+
 class Matcher:
-    @staticmethod
-    async def start_iter():
+    def __init__(self, engine_name:str | None = None, block_size:int = CONFIG.match_block_size, max_distance:float | None = None, workers:int = CONFIG.match_workers, histogram:bool = False) -> None:
         """
-        Compares each hash in each hashing method.
+        engine_name: Registered match engine. Defaults to "mih" if max_distance is given, otherwise CONFIG.match_engine
+        max_distance: Only store pairs with a normalized hamming distance at or below this.
+        workers: Amount of processes comparing tiles, 1 compares in the matcher process. For the sql engine the amount of database connections.
+        histogram: Count every pair in match_histograms. Pairs are then only stored in matches if max_distance is given.
         """
-        with db.Database.from_config() as database:
-            for hash_method in iter_hash_methods(database):
-                database.commit()
-                for hash in iter_hashes(database, hash_method.id):
-                    for compare in iter_hashes(database,hash_method.id, min_id=hash.id):   # min_id: Start at the id of the current hash being compared. This way, (A,B) and (B,A) are skipped
-                        hamming = match_images(hash.hash, compare.hash)
-                        id = database.add_hamming_distance(hamming, hash.id, compare.id)
+        if engine_name is None:
+            engine_name = "mih" if max_distance is not None and not histogram else CONFIG.match_engine
+
+        self.match_engine:engine.MatchEngine | engine.DatabaseMatching
+        if engine_name == engine.DATABASE_ENGINE:
+            if histogram:
+                raise ValueError("Histograms need an engine that compares every pair in the matcher")
+            self.match_engine = engine.DatabaseMatching(block_size, max_distance)
+        elif histogram:
+            self.match_engine = engine.HistogramEngine(engine.MatchEngines.get(engine_name)(block_size), max_distance)
+        else:
+            self.match_engine = engine.MatchEngines.get(engine_name)(block_size, max_distance)
+        self.in_database = isinstance(self.match_engine, engine.DatabaseMatching)
+        self.engine_name = engine_name
+        self.workers = workers
+        self.histogram = histogram
+        self.written_in_database = 0
+        self.progress = MatchProgress()
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.stopping = False
+
+    @property
+    def interrupted(self)->bool:
+        return self.stopping or not self.resumed.is_set()
+
+    def pause(self):
+        """
+        Stops leasing tiles. Tiles in flight are finished and committed, the rest of the leases released,
+        then the matcher waits for resume.
+        """
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def stop(self):
+        """
+        Like pause, but start_iter ends afterwards. The run is continued by the next matcher started with the same settings.
+        """
+        self.stopping = True
+        self.resumed.set()
+
+    async def start_iter(self):
+        """
+        Compares each hash in each hashing method. Yields the amount of pairs compared per tile.
+        All hashes of a method are loaded once into a HashMatrix, then compared tile by tile by the match engine.
+        Tiles are leased from match_tiles, so several matcher replicas can share a run, and an unfinished run
+        with the same engine settings is resumed. When the only tiles left are leased by other matchers, the matcher waits for them,
+        leasing them once their lease expires, so a run is only left once every tile is done.
+        Matches are buffered and bulk written by a db.MatchWriter, which marks each tile done with its matches.
+        In histogram mode the distance counts of each tile are written with its checkpoint as well.
+        Blocking database calls and comparisons run in threads, and the writer has its own thread and connection,
+        so the event loop stays responsive and comparing overlaps with writing.
+        """
+        with db.Database.from_config() as database, db.Database.from_config() as writer_database, \
+                db.MatchWriter(writer_database, CONFIG.matcher_id, CONFIG.match_flush_rows, CONFIG.match_flush_interval) as writer:
+            self.progress.phase = MatchPhase.LOADING
+            hash_methods = await asyncio.to_thread(lambda: list(iter_hash_methods(database)))
+            hash_counts = await asyncio.to_thread(database.count_hashes_per_method)
+            self.progress.expected_pairs = {method_id: n * (n + 1) // 2 for method_id, n in hash_counts.items()}
+
+            for hash_method in hash_methods:
+                self.progress.phase = MatchPhase.LOADING
+                run = await asyncio.to_thread(self._start_run, database, hash_method.id)
+                if run is None:
+                    logger.info(f"Hashing method {hash_method.id} is already matched")
+                    continue
+
+                if self.in_database:
+                    # Only the hash ids are loaded, to translate tile positions into id ranges
+                    ids = await asyncio.to_thread(database.get_hash_ids, hash_method.id, run.max_hash_id)
+                    tiles = {(t.row_start, t.col_start): t for t in self.match_engine.tiles(len(ids))}
+                    logger.info(f"Matching {len(ids)} hashes for hashing method {hash_method.id} in the database")
+                else:
+                    matrix = await asyncio.to_thread(load_matrix, database, hash_method.id, run.max_hash_id)
+                    tiles = {(t.row_start, t.col_start): t for t in self.match_engine.tiles(len(matrix))}
+                    logger.info(f"Loaded {len(matrix)} hashes for hashing method {hash_method.id}")
+                await asyncio.to_thread(self._start_progress, database, hash_method.id)
+
+                while True:
+                    self.progress.phase = MatchPhase.COMPARING
+                    leased = self._lease_iter(database, hash_method.id, tiles)
+                    if self.in_database:
+                        async for tile in self._database_iter(hash_method.id, ids, leased):
+                            self.progress.add(tile.pairs, writer.written + self.written_in_database)
+                            yield tile.pairs
+                    else:
+                        async for tile, block in self._compare_iter(matrix, leased):
+                            checkpoint = (hash_method.id, tile.row_start, tile.col_start)
+                            if writer.add(hash_method.id, block.distance.tolist(), block.hash_id1.tolist(), block.hash_id2.tolist(), checkpoint, block.histogram):
+                                self.progress.phase = MatchPhase.FLUSHING
+                                await writer.flush()
+                                self.progress.phase = MatchPhase.COMPARING
+
+                            self.progress.add(tile.pairs, writer.written + self.written_in_database)
+                            yield tile.pairs
+
+                    self.progress.phase = MatchPhase.FLUSHING
+                    await writer.flush(wait=True)
+                    self.progress.rows_written = writer.written + self.written_in_database
+                    if not self.interrupted:
+                        if await asyncio.to_thread(finish_run, database, hash_method.id):
+                            break
+
+                        # The rest of the tiles are leased by other matchers. Their tiles are leased here once the lease expires, if they crashed
+                        logger.info(f"No free tiles left for hashing method {hash_method.id}, waiting for the tiles leased by other matchers")
+                        self.progress.phase = MatchPhase.WAITING
+                        await asyncio.sleep(LEASE_POLL_SECONDS)
+                        continue
+
+                    # Every compared tile is committed, so the tiles still leased by this matcher were never started
+                    await asyncio.to_thread(release_tiles, database, hash_method.id)
+                    if self.stopping:
+                        logger.info(f"Stopped matching hashing method {hash_method.id}")
+                        self.progress.phase = MatchPhase.STOPPED
+                        return
+
+                    logger.info(f"Paused matching hashing method {hash_method.id}")
+                    self.progress.phase = MatchPhase.PAUSED
+                    await self.resumed.wait()
+                    logger.info(f"Resumed matching hashing method {hash_method.id}")
+
+                logger.info(f"Done matching hashing method {hash_method.id}, {writer.written + self.written_in_database} matches written in total")
 
-                        if id is None:
-                            logging.info(f"Match with values hamming: {hamming}, image_id1: {hash.id} image_id2: {compare.id} already exists")
-                            continue
+            self.progress.rows_written = writer.written + self.written_in_database
+            self.progress.phase = MatchPhase.DONE
 
-                        yield Match(id, hamming, hash.id, compare.id)
+    def _start_run(self, database:db.Database, method_id:int)->db.MatchRun | None:
+        run = self._get_run(database, method_id)
+        database.commit()
+        return run
 
-                        if id % 50 == 0:
-                            await asyncio.sleep(0)
+    def _start_progress(self, database:db.Database, method_id:int):
+        pairs_done, pairs_total = database.get_run_pairs(method_id)
+        self.progress.start_run(method_id, pairs_total, pairs_done)
 
-def iter_hashes(database:db.Database, method_id:int, min_id:int = 1)->Generator[db.Hash]:
+    def _get_run(self, database:db.Database, method_id:int)->db.MatchRun | None:
+        """
+        Returns the run to continue for the hashing method, starting a new one if the last run used other settings or
+        new hashes were added after it finished. Returns None if there is nothing left to match.
+        """
+        database.lock_match_run(method_id)
+        max_hash_id = database.get_max_hash_id(method_id)
+        if max_hash_id is None:
+            return None
+
+        new_run = db.MatchRun(method_id, self.engine_name, self.match_engine.block_size, self.match_engine.max_distance, max_hash_id, histogram=self.histogram)
+        run = database.get_match_run(method_id)
+
+        same_settings = run is not None and (run.engine, run.block_size, run.max_distance, run.histogram) == (new_run.engine, new_run.block_size, new_run.max_distance, new_run.histogram)
+        if run is not None and same_settings and not run.done:
+            logger.info(f"Joining matching of hashing method {method_id} up to hash {run.max_hash_id}")
+            # A restarted matcher keeps its matcher_id, so tiles still leased by it were never finished. Free them instead of waiting for the lease
+            database.release_tiles(method_id, CONFIG.matcher_id)
+            return run
+
+        if run is not None and same_settings and run.max_hash_id == max_hash_id:
+            return None
+
+        if run is not None and not run.done:
+            logger.warning(f"Replacing unfinished run of hashing method {method_id} that used other settings")
+
+        n = database.count_hashes(method_id, max_hash_id)
+        database.start_match_run(new_run, [(t.row_start, t.col_start, t.pairs) for t in self.match_engine.tiles(n)])
+        return new_run
+
+    async def _lease_iter(self, database:db.Database, method_id:int, tiles:dict[tuple[int, int], engine.Tile])->AsyncGenerator[engine.Tile]:
+        """
+        Leases tiles of the run in batches until no free ones are left, or the matcher is paused or stopped
+        """
+        while not self.interrupted:
+            leased = await asyncio.to_thread(lease_tiles, database, method_id, self.workers * 2)
+            if not leased:
+                return
+
+            for key in leased:
+                if self.interrupted:
+                    return
+                yield tiles[key]
+
+    async def _compare_iter(self, matrix:engine.HashMatrix, tiles:AsyncIterator[engine.Tile])->AsyncGenerator[tuple[engine.Tile, engine.DistanceBlock]]:
+        """
+        Compares tiles, in a process pool if there are several workers, otherwise on a thread. Tiles are yielded in the order they finish.
+        At most two tiles per worker are in flight, so finished blocks never pile up in memory.
+        """
+        assert isinstance(self.match_engine, engine.MatchEngine)
+        if self.workers <= 1:
+            async for tile in tiles:
+                yield tile, await asyncio.to_thread(self.match_engine.compare, matrix, tile)
+            return
+
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn") # The matcher runs threads, so forking is unsafe
+        with ProcessPoolExecutor(self.workers, mp_context=context, initializer=engine.init_worker, initargs=(self.match_engine, matrix)) as pool:
+            pending = set()
+            while True:
+                while len(pending) < self.workers * 2 and (tile := await anext(tiles, None)) is not None:
+                    pending.add(loop.run_in_executor(pool, engine.compare_in_worker, tile))
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    async def _database_iter(self, method_id:int, ids:list[int], tiles:AsyncIterator[engine.Tile])->AsyncGenerator[engine.Tile]:
+        """
+        Matches tiles inside the database, with one connection per worker so Postgres runs them in parallel.
+        ids: Hash ids in matching order, to translate tile positions into id ranges. Tiles are yielded in the order they finish.
+        """
+        with ExitStack() as stack:
+            connections = [stack.enter_context(db.Database.from_config()) for _ in range(self.workers)]
+            pending:dict[asyncio.Future[int], tuple[db.Database, engine.Tile]] = {}
+            while True:
+                while connections and (tile := await anext(tiles, None)) is not None:
+                    connection = connections.pop()
+                    rows = (ids[tile.row_start], ids[tile.row_stop - 1])
+                    cols = (ids[tile.col_start], ids[tile.col_stop - 1])
+                    future = asyncio.ensure_future(asyncio.to_thread(match_tile, connection, method_id, rows, cols, self.match_engine.max_distance, tile))
+                    pending[future] = (connection, tile)
+
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    connection, tile = pending.pop(future)
+                    connections.append(connection)
+                    self.written_in_database += future.result()
+                    yield tile
+
+def load_matrix(database:db.Database, method_id:int, max_hash_id:int)->engine.HashMatrix:
+    hashes = list(iter_hashes(database, method_id, amount=LOAD_BATCH_SIZE, max_id=max_hash_id))
+    return engine.HashMatrix.from_hashes(hashes)
+
+def lease_tiles(database:db.Database, method_id:int, amount:int)->list[tuple[int, int]]:
+    leased = database.lease_tiles(method_id, CONFIG.matcher_id, amount, CONFIG.match_lease_seconds)
+    database.commit()
+    return leased
+
+def release_tiles(database:db.Database, method_id:int):
+    database.release_tiles(method_id, CONFIG.matcher_id)
+    database.commit()
+
+def finish_run(database:db.Database, method_id:int)->bool:
+    finished = database.finish_match_run(method_id)
+    database.commit()
+    return finished
+
+def match_tile(database:db.Database, method_id:int, rows:tuple[int, int], cols:tuple[int, int], max_distance:float | None, tile:engine.Tile)->int:
+    """
+    Runs and commits one tile of the sql engine. Returns the amount of new matches
+    """
+    inserted = database.match_tile(method_id, rows, cols, max_distance, (tile.row_start, tile.col_start))
+    database.commit()
+    return inserted
+
+def evaluate(label:evaluation.Label = evaluation.Label.IMAGE)->list[evaluation.Evaluation]:
+    """
+    Evaluates every hashing method with histograms and stores the results in match_evaluations
+    """
+    with db.Database.from_config() as database:
+        evaluations = []
+        for method_id, bits in database.get_histogram_methods():
+            evaluations += evaluation.evaluate_histograms(method_id, bits, database.get_match_histograms(method_id), label)
+
+        if evaluations:
+            database.save_evaluations(evaluations)
+        return evaluations
+
+def get_match_progress()->list[db.MatchRunProgress]:
+    with db.Database.from_config() as database:
+        return database.get_match_progress()
+
+def iter_hashes(database:db.Database, method_id:int, min_id:int = 1, amount:int = 100, max_id:int | None = None)->Generator[db.Hash]:
     """
     Iterates over all hashes in db, sequentially and in batches.
     """
-    amount=100
     while True:
-        batch = database.get_hashes(amount, min_id, method_id)
+        batch = database.get_hashes(amount, min_id, method_id, max_id)
         if not batch:
             break
         for i in batch:
@@ -69,17 +425,16 @@ def iter_hash_methods(database:db.Database, min_id:int = 1)->Generator[db.HashMe
         min_id += amount
 
 
-def match_images(hash1:str, hash2:str)->float:
-    if len(hash1) != len(hash2):
+def match_images(hash1:db.Hash, hash2:db.Hash)->int:
+    """
+    Amount of differing bits between two hashes
+    """
+    if hash1.bits != hash2.bits:
         raise ValueError("Hashes must have the same length")
 
-    int1 = int(hash1, 16)
-    int2 = int(hash2, 16)
+    int1 = int.from_bytes(hash1.hash)
+    int2 = int.from_bytes(hash2.hash)
 
     xor = int1 ^ int2
-    distance = bin(xor).count("1")
-
-    total_bits = len(hash1) * 4
-
-    return distance / total_bits
+    return xor.bit_count()
 
@@ -1,16 +1,21 @@
 from dataclasses import dataclass
 from re import Match
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
 from . import lib
+from . import engine
+from . import evaluation
 from enum import Enum
 from .lib import logger
 
 import asyncio
+import dataclasses
+import psycopg2
 
 class MatchState(str, Enum):
     DONE = "done"
     IN_PROGRESS = "in progress"
+    PAUSED = "paused"
     FAILED = "failed"
     STOPPED = "stopped"
 
@@ -18,41 +23,159 @@ class MatchStatus(BaseModel):
     state: MatchState
     processed: int
 
+class MatchRunProgress(BaseModel):
+    """
+    Progress of a hashing method summed over every matcher replica
+    """
+    hashing_method_id: int
+    done: bool
+    tiles_pending: int
+    tiles_leased: int
+    tiles_done: int
+    pairs_done: int
+    pairs_total: int
+
+class MatchReport(BaseModel):
+    """
+    Progress of this matcher, see lib.MatchReport. Rates are over the last 10 (short) and 60 (long) seconds.
+    """
+    phase: lib.MatchPhase
+    hashing_method_id: int | None
+    pairs_total: int
+    pairs_done: int
+    pairs_compared: int
+    rows_written: int
+    pairs_per_second_short: float
+    pairs_per_second_long: float
+    rows_per_second_short: float
+    rows_per_second_long: float
+    eta_seconds: float | None
+    expected_pairs: dict[int, int]
+
+class MatchRequest(BaseModel):
+    engine: str | None = None
+    max_distance: float | None = Field(default=None, ge=0, le=1)
+    workers: int = Field(default=lib.CONFIG.match_workers, ge=1)
+    histogram: bool = False
+
 
 router = APIRouter()
 
 state =  MatchStatus(state=MatchState.STOPPED, processed=0)
+matcher:lib.Matcher | None = None
 
 @router.post("/match/start")
-async def match_hashes():
-    global state
-
-    if state.state == MatchState.IN_PROGRESS:
+async def match_hashes(req:MatchRequest | None = None):
+    """
+    Starts matching all hashes. With max_distance only pairs at or below that normalized hamming distance are stored,
+    using the multi-index "mih" engine unless another engine is given. The "sql" engine matches inside the database.
+    With histogram every pair is counted per distance in match_histograms instead, and max_distance limits the stored pairs.
+    """
+    global state, matcher
+
+    if state.state in (MatchState.IN_PROGRESS, MatchState.PAUSED):
         return {"state": state}
 
+    req = req or MatchRequest()
+    try:
+        matcher = loader = lib.Matcher(req.engine, max_distance=req.max_distance, workers=req.workers, histogram=req.histogram)
+    except (engine.UnknownEngineError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     async def run_match():
         try:
-            state.state = MatchState.IN_PROGRESS
-            loader = lib.Matcher
-            async for _ in loader.start_iter():
-                state.processed += 1
+            async for compared in loader.start_iter():
+                state.processed += compared
 
         except Exception as e:
             state.state = MatchState.FAILED
             logger.error(e)
             return
 
-        state.state = MatchState.DONE
+        state.state = MatchState.STOPPED if loader.stopping else MatchState.DONE
 
+    state.state = MatchState.IN_PROGRESS
     asyncio.create_task(run_match())
     return {"state": state}
 
+@router.post("/match/stop")
+async def stop_matching():
+    """
+    Stops the run after the tiles in flight are compared and committed. Starting again with the same settings continues it.
+    state stays in progress until the matcher has stopped.
+    """
+    if matcher is not None and state.state in (MatchState.IN_PROGRESS, MatchState.PAUSED):
+        matcher.stop()
+        state.state = MatchState.IN_PROGRESS
+    return {"state": state}
+
+@router.post("/match/pause")
+async def pause_matching():
+    """
+    Pauses after the tiles in flight are compared and committed, releasing the rest of the leased tiles.
+    progress.phase is paused once nothing is written anymore.
+    """
+    if matcher is not None and state.state == MatchState.IN_PROGRESS and not matcher.stopping:
+        matcher.pause()
+        state.state = MatchState.PAUSED
+    return {"state": state}
+
+@router.post("/match/resume")
+async def resume_matching():
+    if matcher is not None and state.state == MatchState.PAUSED:
+        matcher.resume()
+        state.state = MatchState.IN_PROGRESS
+    return {"state": state}
+
 @router.post("/match/status")
 async def match_status():
+    """
+    state and progress are of this matcher, runs the progress of all matchers sharing the database
+    """
     global state
 
-    return {"state": state}
-
+    try:
+        progress = await asyncio.to_thread(lib.get_match_progress)
+    except psycopg2.Error as e:
+        logger.warning(f"Could not get match progress: {e}")
+        progress = []
+
+    runs = [MatchRunProgress(**dataclasses.asdict(p)) for p in progress]
+    report = MatchReport(**dataclasses.asdict(matcher.progress.report())) if matcher is not None else None
+    return {"state": state, "progress": report, "runs": runs}
+
+
+class EvaluationRequest(BaseModel):
+    label: evaluation.Label = evaluation.Label.IMAGE
+
+class Evaluation(BaseModel):
+    hashing_method_id: int
+    modification_id: int | None
+    label: evaluation.Label
+    genuine_pairs: int
+    impostor_pairs: int
+    tpr: list[float]
+    fpr: list[float]
+    eer: float
+    eer_threshold: int
+    best_threshold: int
+    best_tpr: float
+    best_fpr: float
+
+@router.post("/match/evaluate")
+async def evaluate(req:EvaluationRequest | None = None):
+    """
+    Computes ROC curves, EER and best thresholds per hashing method and modification from match_histograms,
+    so only histogram runs are evaluated. Results are also stored in match_evaluations.
+    label decides which pairs are genuine: same source image, or same user.
+    """
+    req = req or EvaluationRequest()
+    try:
+        evaluations = await asyncio.to_thread(lib.evaluate, req.label)
+    except psycopg2.Error as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {"evaluations": [Evaluation(**dataclasses.asdict(e)) for e in evaluations]}
 
 @router.get("/match/health")
 def health():
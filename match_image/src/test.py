@@ -0,0 +1,331 @@
+import unittest
+import random
+from collections import Counter
+import numpy
+from unittest.mock import AsyncMock, MagicMock, patch
+from src import engine
+from src import db
+from src import lib
+from src import evaluation
+from src.lib import match_images
+
+class HashFactory():
+    @staticmethod
+    def random_hashes(amount:int, bits:int = 64)->list[db.Hash]:
+        ids = random.sample(range(1, amount * 10), amount)
+        return [HashFactory.from_int(id, random.getrandbits(bits), bits) for id in ids]
+
+    @staticmethod
+    def from_int(id:int, value:int, bits:int)->db.Hash:
+        """
+        Packs value like the hasher does, with the bits left aligned in whole bytes
+        """
+        size = -(-bits // 8)
+        return db.Hash(id, (value << (size * 8 - bits)).to_bytes(size), bits)
+
+    @staticmethod
+    def similar_hashes(amount:int, flips:int = 6, bits:int = 64)->list[db.Hash]:
+        """
+        Hashes in small groups, each a copy of a random hash with up to `flips` bits flipped
+        """
+        hashes = HashFactory.random_hashes(amount, bits)
+        for i in range(1, amount, 2):
+            value = int.from_bytes(hashes[i - 1].hash) >> (len(hashes[i - 1].hash) * 8 - bits)
+            for bit in random.sample(range(bits), random.randint(0, flips)):
+                value ^= 1 << bit
+            hashes[i] = HashFactory.from_int(hashes[i].id, value, bits)
+        return hashes
+
+def brute_force(hashes:list[db.Hash], max_distance:float = 1.0)->dict[tuple[int, int], int]:
+    result = {}
+    for a in hashes:
+        for b in hashes:
+            hd = match_images(a, b)
+            if a.id <= b.id and hd <= max_distance * a.bits + 1e-9:
+                result[(a.id, b.id)] = hd
+    return result
+
+def collect(match_engine:engine.MatchEngine, matrix:engine.HashMatrix)->dict[tuple[int, int], int]:
+    result = {}
+    for tile in match_engine.tiles(len(matrix)):
+        block = match_engine.compare(matrix, tile)
+        for id1, id2, hd in zip(block.hash_id1.tolist(), block.hash_id2.tolist(), block.distance.tolist()):
+            assert (id1, id2) not in result, f"Pair {(id1, id2)} compared twice"
+            result[(id1, id2)] = hd
+    return result
+
+class TestHashMatrix(unittest.TestCase):
+    def test_sorted_by_id(self):
+        hashes = HashFactory.random_hashes(50)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        self.assertTrue(numpy.all(numpy.diff(matrix.ids) > 0))
+
+    def test_words(self):
+        matrix = engine.HashMatrix.from_hashes([db.Hash(1, bytes.fromhex("ff00000000000001"), 64)])
+        self.assertEqual(int(matrix.words[0, 0]), 0xff00000000000001)
+        self.assertEqual(matrix.bits, 64)
+
+    def test_unaligned_bits(self):
+        matrix = engine.HashMatrix.from_hashes([HashFactory.from_int(1, 0b101, 3)])
+        self.assertEqual(int(matrix.words[0, 0]), 0b101)
+        self.assertEqual(matrix.bits, 3)
+
+    def test_different_lengths(self):
+        with self.assertRaises(ValueError):
+            engine.HashMatrix.from_hashes([db.Hash(1, b"\xff", 8), db.Hash(2, b"\xff\xff", 16)])
+
+class TestNumpyEngine(unittest.TestCase):
+    def test_matches_brute_force(self):
+        hashes = HashFactory.random_hashes(70)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        self.assertEqual(collect(engine.NumpyEngine(block_size=16), matrix), brute_force(hashes))
+
+    def test_multi_word_hashes(self):
+        hashes = HashFactory.random_hashes(30, bits=256 + 12)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        self.assertEqual(collect(engine.NumpyEngine(block_size=8), matrix), brute_force(hashes))
+
+    def test_tile_pairs(self):
+        match_engine = engine.NumpyEngine(block_size=7)
+        n = 40
+        self.assertEqual(sum(tile.pairs for tile in match_engine.tiles(n)), n * (n + 1) // 2)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(engine.UnknownEngineError):
+            engine.MatchEngines.get("does-not-exist")
+
+    def test_max_distance(self):
+        hashes = HashFactory.similar_hashes(60)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        self.assertEqual(collect(engine.NumpyEngine(block_size=16, max_distance=0.1), matrix), brute_force(hashes, 0.1))
+
+class TestMultiIndexEngine(unittest.TestCase):
+    "Small corpora would fall back to brute force, so PROBE_COST is patched to always use the index"
+    def setUp(self) -> None:
+        self.probe_cost_patcher = patch.object(engine, "PROBE_COST", 0)
+        self.probe_cost_patcher.start()
+
+    def tearDown(self) -> None:
+        self.probe_cost_patcher.stop()
+
+    def test_matches_brute_force(self):
+        hashes = HashFactory.similar_hashes(200)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        for max_distance in (0.0, 0.1, 0.2, 0.4):
+            with self.subTest(max_distance=max_distance):
+                match_engine = engine.MultiIndexEngine(block_size=32, max_distance=max_distance)
+                self.assertEqual(collect(match_engine, matrix), brute_force(hashes, max_distance))
+
+    def test_multi_word_hashes(self):
+        hashes = HashFactory.similar_hashes(80, flips=20, bits=256)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        match_engine = engine.MultiIndexEngine(block_size=16, max_distance=0.1)
+        self.assertEqual(collect(match_engine, matrix), brute_force(hashes, 0.1))
+
+    def test_requires_max_distance(self):
+        with self.assertRaises(ValueError):
+            engine.MultiIndexEngine()
+
+    def test_brute_force_fallback(self):
+        self.probe_cost_patcher.stop()
+        hashes = HashFactory.similar_hashes(100)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        match_engine = engine.MultiIndexEngine(block_size=32, max_distance=0.4)
+        self.assertEqual(collect(match_engine, matrix), brute_force(hashes, 0.4))
+        self.probe_cost_patcher.start()
+
+class TestDatabaseMatching(unittest.TestCase):
+    def test_not_a_match_engine(self):
+        with self.assertRaises(engine.UnknownEngineError):
+            engine.MatchEngines.get(engine.DATABASE_ENGINE)
+
+    def test_tiles_cover_every_pair(self):
+        tiles = engine.DatabaseMatching(block_size=16).tiles(100)
+        self.assertEqual(sum(t.pairs for t in tiles), 100 * 101 // 2)
+
+    def test_matcher(self):
+        self.assertTrue(lib.Matcher(engine.DATABASE_ENGINE).in_database)
+        self.assertFalse(lib.Matcher("numpy").in_database)
+        with self.assertRaises(ValueError):
+            lib.Matcher(engine.DATABASE_ENGINE, histogram=True)
+
+class TestMatcherLeases(unittest.IsolatedAsyncioTestCase):
+    """
+    Runs Matcher.start_iter against a fake database, leasing with lease_tiles
+    """
+    def setUp(self) -> None:
+        self.matrix = engine.HashMatrix.from_hashes(HashFactory.random_hashes(40))
+        self.matcher = lib.Matcher("numpy", block_size=16, workers=1)
+        self.tiles = [(t.row_start, t.col_start) for t in self.matcher.match_engine.tiles(len(self.matrix))]
+
+        writer = MagicMock(written=0)
+        writer.__enter__.return_value = writer
+        writer.add.return_value = False
+        writer.flush = AsyncMock()
+        self.lease_tiles = MagicMock()
+        self.finish_run = MagicMock()
+        self.patchers = [
+            patch.object(lib.db.Database, "from_config", return_value=MagicMock()),
+            patch.object(lib.db, "MatchWriter", return_value=writer),
+            patch.object(lib, "iter_hash_methods", return_value=[db.HashMethod(1)]),
+            patch.object(lib, "load_matrix", return_value=self.matrix),
+            patch.object(lib, "lease_tiles", self.lease_tiles),
+            patch.object(lib, "finish_run", self.finish_run),
+            patch.object(lib, "release_tiles"),
+            patch.object(lib, "LEASE_POLL_SECONDS", 0),
+            patch.object(lib.Matcher, "_start_run", return_value=db.MatchRun(1, "numpy", 16, None, 400)),
+            patch.object(lib.Matcher, "_start_progress"),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_waits_for_other_matchers(self):
+        """
+        Tiles leased by a crashed matcher are leased here once their lease expired, before the run is done
+        """
+        self.lease_tiles.side_effect = [[], [], self.tiles, []]
+        self.finish_run.side_effect = [False, False, True]
+
+        pairs = [pairs async for pairs in self.matcher.start_iter()]
+
+        self.assertEqual(sum(pairs), len(self.matrix) * (len(self.matrix) + 1) // 2)
+        self.assertEqual(self.finish_run.call_count, 3)
+        self.assertEqual(self.matcher.progress.phase, lib.MatchPhase.DONE)
+
+    def test_resume_after_crash(self):
+        """
+        A matcher restarted with the same matcher_id frees the tiles it leased before crashing when it joins the run
+        """
+        database = MagicMock()
+        database.get_max_hash_id.return_value = 400
+        database.get_match_run.return_value = db.MatchRun(1, "numpy", 16, None, 400)
+
+        self.assertEqual(self.matcher._get_run(database, 1), database.get_match_run.return_value)
+        database.release_tiles.assert_called_once_with(1, lib.CONFIG.matcher_id)
+        database.start_match_run.assert_not_called()
+
+class TestHistogramEngine(unittest.TestCase):
+    def labelled_hashes(self, amount:int)->list[db.Hash]:
+        hashes = HashFactory.similar_hashes(amount)
+        for h in hashes:
+            h.hash_method_id = 1
+            h.modification_id = random.choice((3, 5, 8))
+            h.image_id = random.randint(1, amount // 4)
+            h.user_id = random.choice((1, 2, None))
+        return hashes
+
+    def expected_histogram(self, hashes:list[db.Hash])->Counter:
+        expected = Counter()
+        for a in hashes:
+            for b in hashes:
+                if a.id <= b.id:
+                    mods = sorted((a.modification_id, b.modification_id))
+                    same_user = a.user_id is not None and a.user_id == b.user_id
+                    expected[(*mods, a.image_id == b.image_id, same_user, match_images(a, b))] += 1
+        return expected
+
+    def test_matches_brute_force(self):
+        hashes = self.labelled_hashes(90)
+        matrix = engine.HashMatrix.from_hashes(hashes)
+        match_engine = engine.HistogramEngine(engine.NumpyEngine(block_size=16), max_distance=0.1)
+
+        histogram = None
+        pairs = {}
+        for tile in match_engine.tiles(len(matrix)):
+            block = match_engine.compare(matrix, tile)
+            assert block.histogram is not None
+            histogram = block.histogram if histogram is None else histogram.merge(block.histogram)
+            pairs.update(zip(zip(block.hash_id1.tolist(), block.hash_id2.tolist()), block.distance.tolist()))
+
+        assert histogram is not None
+        self.assertEqual(Counter({row[:5]: row[5] for row in histogram.rows()}), self.expected_histogram(hashes))
+        self.assertEqual(pairs, brute_force(hashes, 0.1))
+
+    def test_without_pairs(self):
+        matrix = engine.HashMatrix.from_hashes(self.labelled_hashes(20))
+        match_engine = engine.HistogramEngine(engine.NumpyEngine(block_size=8))
+        self.assertTrue(all(len(match_engine.compare(matrix, tile)) == 0 for tile in match_engine.tiles(len(matrix))))
+
+    def test_requires_every_pair(self):
+        with self.assertRaises(ValueError):
+            engine.HistogramEngine(engine.NumpyEngine(max_distance=0.1))
+
+class TestMatchWriter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.writer = db.MatchWriter(None, "matcher", 1000, 60) # type: ignore[arg-type] # Nothing is written
+
+    def tearDown(self) -> None:
+        self.writer.close()
+
+    def test_histograms_per_tile(self):
+        matrix = engine.HashMatrix.from_hashes(TestHistogramEngine().labelled_hashes(20))
+        match_engine = engine.HistogramEngine(engine.NumpyEngine(block_size=8))
+        for tile in match_engine.tiles(len(matrix)):
+            block = match_engine.compare(matrix, tile)
+            self.writer.add(1, [], [], [], (1, tile.row_start, tile.col_start), block.histogram)
+
+        self.assertEqual(len(self.writer.batch.histograms), len(match_engine.tiles(len(matrix))))
+
+    def test_histogram_needs_checkpoint(self):
+        matrix = engine.HashMatrix.from_hashes(TestHistogramEngine().labelled_hashes(8))
+        match_engine = engine.HistogramEngine(engine.NumpyEngine(block_size=8))
+        block = match_engine.compare(matrix, match_engine.tiles(len(matrix))[0])
+        with self.assertRaises(ValueError):
+            self.writer.add(1, [], [], [], None, block.histogram)
+
+class TestMatchProgress(unittest.TestCase):
+    def test_rates_and_eta(self):
+        progress = lib.MatchProgress()
+        progress.start_run(1, pairs_total=1000, pairs_done=100)
+        with patch.object(lib.time, "monotonic", side_effect=[0.0, 5.0, 5.0, 5.0]):
+            progress.add(100, 10)
+            progress.add(400, 50)
+            report = progress.report()
+
+        self.assertEqual(report.pairs_done, 600)
+        self.assertEqual(report.pairs_per_second_short, 80.0)
+        self.assertEqual(report.rows_per_second_short, 8.0)
+        self.assertEqual(report.eta_seconds, 5.0)
+
+    def test_no_samples(self):
+        report = lib.MatchProgress().report()
+        self.assertEqual(report.pairs_per_second_long, 0.0)
+        self.assertIsNone(report.eta_seconds)
+
+class TestEvaluation(unittest.TestCase):
+    def test_separable(self):
+        genuine = numpy.array([5, 5, 0, 0, 0])
+        impostor = numpy.array([0, 0, 0, 2, 8])
+        result = evaluation.evaluate(1, None, evaluation.Label.IMAGE, genuine, impostor)
+        assert result is not None
+        self.assertEqual(result.tpr, [0.5, 1.0, 1.0, 1.0, 1.0])
+        self.assertEqual(result.fpr, [0.0, 0.0, 0.0, 0.2, 1.0])
+        self.assertEqual(result.eer, 0.0)
+        self.assertEqual(result.best_threshold, 1)
+
+    def test_overlapping(self):
+        genuine = numpy.array([0, 6, 4])
+        impostor = numpy.array([0, 4, 6])
+        result = evaluation.evaluate(1, None, evaluation.Label.IMAGE, genuine, impostor)
+        assert result is not None
+        self.assertEqual(result.eer_threshold, 1)
+        self.assertAlmostEqual(result.eer, 0.4)
+
+    def test_without_impostors(self):
+        self.assertIsNone(evaluation.evaluate(1, None, evaluation.Label.IMAGE, numpy.array([1, 2]), numpy.zeros(2)))
+
+    def test_histograms(self):
+        rows = [
+            (1, 1, True, True, 0, 10), # Hashes compared with themselves
+            (1, 2, True, True, 1, 4),
+            (1, 2, False, True, 3, 6),
+            (2, 2, False, False, 2, 8),
+        ]
+        results = {r.modification_id: r for r in evaluation.evaluate_histograms(7, 3, rows)}
+        self.assertEqual(set(results), {None, 1, 2})
+        self.assertEqual((results[None].genuine_pairs, results[None].impostor_pairs), (4, 14))
+        self.assertEqual((results[1].genuine_pairs, results[1].impostor_pairs), (4, 6))
+
+        by_user = {r.modification_id: r for r in evaluation.evaluate_histograms(7, 3, rows, evaluation.Label.USER)}
+        self.assertEqual((by_user[None].genuine_pairs, by_user[None].impostor_pairs), (10, 8))
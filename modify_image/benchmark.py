@@ -0,0 +1,69 @@
+"""
+Compares writing modified images in every ImageFormat and reading them back like the hasher does, on synthetic images.
+Files are written to a temporary directory, by default in the system temp dir, use --dir to measure another disk.
+
+    python benchmark.py --images 20 --resolutions 1024x768 3000x2000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from src.image import ImageFormat, SUFFIXES, save_image
+
+RESOLUTIONS = ["1024x768", "3000x2000"]
+
+def synthetic_image(rng:np.random.Generator, width:int, height:int)->Image.Image:
+    """
+    Smooth blobs with some noise, compressing roughly like a photo
+    """
+    blobs = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8), "RGB").resize((width, height), Image.Resampling.BICUBIC)
+    noise = rng.normal(0, 8, (height, width, 3))
+    return Image.fromarray(np.clip(np.asarray(blobs) + noise, 0, 255).astype(np.uint8), "RGB")
+
+def read_image(path:Path)->Image.Image:
+    """
+    Reads an image like PreparedImage.open of the hasher
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+
+    if magic == b"\x93NUMPY":
+        return Image.fromarray(np.asarray(np.load(path, mmap_mode="r", allow_pickle=False))).convert("RGB")
+
+    with Image.open(path) as open_image:
+        return open_image.convert("RGB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=20, help="Images per resolution")
+    parser.add_argument("--resolutions", nargs="+", default=RESOLUTIONS, help="WIDTHxHEIGHT")
+    parser.add_argument("--dir", type=Path, default=None, help="Directory to write the images to")
+    args = parser.parse_args()
+
+    print(f"{'format':>9} {'resolution':>10} {'write img/s':>11} {'read img/s':>10} {'MiB/img':>8}")
+    for resolution in args.resolutions:
+        width, height = map(int, resolution.split("x"))
+        rng = np.random.default_rng(0)
+        images = [synthetic_image(rng, width, height) for _ in range(args.images)]
+
+        for format in ImageFormat:
+            with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+                paths = [(Path(tmp) / str(i)).with_suffix(SUFFIXES[format]) for i in range(len(images))]
+
+                start = time.perf_counter()
+                for path, img in zip(paths, images):
+                    save_image(path, img, format)
+                write_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for path, img in zip(paths, images):
+                    read_image(path)
+                read_seconds = time.perf_counter() - start
+
+                size = sum(path.stat().st_size for path in paths) / len(paths) / 2**20
+                print(f"{format.value:>9} {resolution:>10} {len(images) / write_seconds:>11.1f} {len(images) / read_seconds:>10.1f} {size:>8.2f}")
+
+if __name__ == "__main__":
+    main()
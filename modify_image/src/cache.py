@@ -0,0 +1,71 @@
+from contextlib import ContextDecorator
+from pathlib import Path
+from typing import Self
+import sqlite3
+import time
+from src import lru
+
+class ModificationCache(ContextDecorator):
+    """
+    Modified images written before, keyed by source path, size and modification time, modification name and modification parameters,
+    in a local SQLite file. Holds about max_entries images, evicting the least recently used ones on commit, see lru.LRUBound.
+    Several modifiers may share the file.
+    """
+    def __init__(self, path:Path, max_entries:int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS modified_images (
+            source TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            modification TEXT NOT NULL,
+            params TEXT NOT NULL,
+            path TEXT NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (source, modification, params)
+        ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS modified_images_used ON modified_images (used)")
+        self.conn.commit()
+        self.bound = lru.LRUBound(self.conn, "modified_images", "source, modification, params", "used", max_entries) # The files are kept
+
+    def get(self, source:Path, size:int, mtime:int, modification:str, params:str)->Path | None:
+        """
+        Returns the path of the modified image, or None if it is not cached or the source changed since
+        """
+        cur = self.conn.execute(
+            "UPDATE modified_images SET used = ? WHERE source = ? AND size = ? AND mtime = ? AND modification = ? AND params = ? RETURNING path",
+            (time.time_ns(), str(source), size, mtime, modification, params)
+        )
+        result = cur.fetchone()
+        if result is None:
+            return None
+
+        return Path(result[0])
+
+    def put(self, source:Path, size:int, mtime:int, modification:str, params:str, path:Path):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO modified_images (source, size, mtime, modification, params, path, used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(source), size, mtime, modification, params, str(path), time.time_ns())
+        )
+        self.bound.add()
+
+    def commit(self):
+        self.bound.evict()
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
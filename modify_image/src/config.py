@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 import dataclasses
 from typing import Self
+from src.image import ImageFormat
 
 DEFAULT_MOD_IMG_PATH = Path().home() / ".cache" / "p_hash" / "mod_imgs"
 DEFAULT_INPUT_IMG_PATH = Path().home() / ".local" / "share" / "p-hash" / "images"
@@ -12,6 +13,11 @@ DEFAULT_POSTGRESQL_DB = "p-hash"
 DEFAULT_POSTGRESQL_USER = "user"
 DEFAULT_POSTGRESQL_PASSWORD = ""  
 
+DEFAULT_MOD_IMG_FORMAT = ImageFormat.PNG
+DEFAULT_MOD_DRAFT_SIZE = 0 # Smallest side JPEG sources may be decoded at for scale invariant modifications, 0 decodes in full
+DEFAULT_MOD_CACHE_PATH = Path().home() / ".cache" / "p_hash" / "mod_cache" / "modifications.sqlite3"
+DEFAULT_MOD_CACHE_SIZE = 1_000_000 # Modified images, 0 disables the cache
+
 
 @dataclasses.dataclass
 class Config:
@@ -22,6 +28,10 @@ class Config:
     postgresql_db: str
     postgresql_user: str
     postgresql_passwd: str
+    mod_img_format: ImageFormat
+    mod_draft_size: int
+    mod_cache_path: Path
+    mod_cache_size: int
 
     @classmethod
     def from_env(cls) -> Self:
@@ -39,6 +49,18 @@ class Config:
         pg_user: str = os.getenv("POSTGRESQL_USER") or DEFAULT_POSTGRESQL_USER
         pg_pass: str = os.getenv("POSTGRESQL_PASSWORD") or DEFAULT_POSTGRESQL_PASSWORD
 
+        format_env: str | None = os.getenv("MOD_IMG_FORMAT")
+        img_format = ImageFormat(format_env) if format_env else DEFAULT_MOD_IMG_FORMAT
+
+        draft_size_env: str | None = os.getenv("MOD_DRAFT_SIZE")
+        draft_size: int = int(draft_size_env) if draft_size_env else DEFAULT_MOD_DRAFT_SIZE
+
+        cache_path_env: str | None = os.getenv("MOD_CACHE_PATH")
+        cache_path = Path(cache_path_env) if cache_path_env else DEFAULT_MOD_CACHE_PATH
+
+        cache_size_env: str | None = os.getenv("MOD_CACHE_SIZE")
+        cache_size: int = int(cache_size_env) if cache_size_env else DEFAULT_MOD_CACHE_SIZE
+
         return cls(
             modified_img_path=mod_img_path,
             input_img_path=input_img_path,
@@ -46,6 +68,10 @@ class Config:
             postgresql_host=pg_host,
             postgresql_db=pg_db,
             postgresql_user=pg_user,
-            postgresql_passwd=pg_pass
+            postgresql_passwd=pg_pass,
+            mod_img_format=img_format,
+            mod_draft_size=draft_size,
+            mod_cache_path=cache_path,
+            mod_cache_size=cache_size
         )
 
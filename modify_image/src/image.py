@@ -1,11 +1,48 @@
+from enum import Enum
 from PIL import Image 
 from pathlib import Path
+import hashlib
+import numpy as np
 
-def open_image(path: Path)->Image.Image:
-    with Image.open(path) as f:
-        return f.copy()    # A little bit eh
+class ImageFormat(str, Enum):
+    """
+    File format of the modified images. The hasher detects it from the file
+    """
+    PNG = "png" # Default zlib compression, smallest files, for archival
+    PNG_FAST = "png-fast" # Uncompressed PNG, still readable by any image viewer
+    NPY = "npy" # Raw RGB pixels, memory mapped by the hasher. Largest files, no encoding or decoding
 
-def save_image(path: Path, img:Image.Image)->None:
-    img.save(path)
+SUFFIXES = {ImageFormat.PNG: ".png", ImageFormat.PNG_FAST: ".png", ImageFormat.NPY: ".npy"}
 
+def open_image(path: Path, draft_size:int | None = None)->Image.Image:
+    """
+    draft_size: Lets JPEGs be decoded at 1/2 to 1/8 scale, keeping both sides at least draft_size pixels. Other formats are decoded in full
+    The file is closed on return, also for multi-frame files such as MPO, and the loaded image stays usable without copying it
+    """
+    with Image.open(path) as img:
+        if draft_size is not None:
+            img.draft(img.mode, (draft_size, draft_size))
+        img.load()
+    return img
 
+def content_digest(img:Image.Image)->str:
+    """
+    The blake2b digest of the pixels and mode of img, which modified images are named by, whatever format they are saved in
+    """
+    hasher = hashlib.blake2b(usedforsecurity=False)
+    hasher.update(img.tobytes())
+    hasher.update(img.mode.encode())
+    return hasher.hexdigest()
+
+def save_image(path: Path, img:Image.Image, format:ImageFormat = ImageFormat.PNG)->None:
+    """
+    path should end with the suffix of format, see SUFFIXES
+    Raw pixels do not carry the mode, so NPY stores them in RGB, the mode the hasher reads every image in. Other modes would be misread, e.g. P as indexes
+    """
+    match format:
+        case ImageFormat.PNG:
+            img.save(path, format="PNG")
+        case ImageFormat.PNG_FAST:
+            img.save(path, format="PNG", compress_level=0)
+        case ImageFormat.NPY:
+            np.save(path, np.asarray(img if img.mode == "RGB" else img.convert("RGB")), allow_pickle=False)
@@ -5,7 +5,7 @@ from src import image
 from src import modification 
 from src import db
 from src import config as cf
-import hashlib
+from src import cache
 from typing import Generator
 import logging
 
@@ -36,57 +36,86 @@ class ImageModifier():
                                     CONFIG.postgresql_passwd, 
                                     CONFIG.postgresql_host, 
                                     CONFIG.postgresql_port)
+        self.cache = cache.ModificationCache(CONFIG.mod_cache_path, CONFIG.mod_cache_size) if CONFIG.mod_cache_size > 0 else None
 
     def start_iter(self, img_obj:db.Image)->Generator[Image]:
         """
         Ensures that modifications are commited to db when there are no more images, even if batch_size is not hit
         """
         try:
-            for mod_img in self._process_iter(img_obj):
-                yield mod_img
+            yield from self._process_iter(img_obj) # Closes it first when stopped early, so its new images are put in the cache
         finally:
             if self.pending > 0:
                 self.database.commit()
             self.database.close()
+            if self.cache is not None:
+                self.cache.commit()
+                self.cache.close()
 
     def _process_iter(self,img_obj:db.Image)->Generator[ModifiedImage]:
         """
         Processes each image, opens it, modifies it, and saves it to a hashed path. Returns modified image path
+        The image is decoded once for all modifications, and only copied for modifications that work in place.
+        With MOD_DRAFT_SIZE JPEGs are decoded once more at reduced scale for the scale invariant modifications.
+        Modified images found in the cache are not made again, so an unchanged image with every modification cached is never decoded.
+        The cache is looked up for every modification first and the new images put in it at the end, committing once each per source image.
         If the image already exists, it is skipped on return (not on load)
         """
         save_path = CONFIG.modified_img_path
-        for mod_name, Mod in modification.Modifications().modifications.items(): 
-
-            logger.info(f"Processing modification: {mod_name}, img: {img_obj.path.name}")
-            img:Image.Image = image.open_image(img_obj.path)
+        sources:dict[int | None, Image.Image] = {} # By draft size
+        stat = img_obj.path.stat()
+
+        mods = []
+        for mod_name, Mod in modification.Modifications().modifications.items():
+            mod = Mod()
+            draft_size = CONFIG.mod_draft_size if CONFIG.mod_draft_size > 0 and mod.scale_invariant else None
+            params = f"{mod.params()},format={CONFIG.mod_img_format.value},draft={draft_size or 0}"
+            mods.append((mod_name, mod, draft_size, params))
+
+        cached:dict[str, Path | None] = {mod_name: None for mod_name, *_ in mods}
+        if self.cache is not None:
+            for mod_name, _, _, params in mods:
+                cached[mod_name] = self.cache.get(img_obj.path, stat.st_size, stat.st_mtime_ns, mod_name, params)
+            self.cache.commit() # Lookups update the recently used time, do not hold the write lock while modifying
+
+        made:list[tuple[str, str, Path]] = []
+        try:
+            for mod_name, mod, draft_size, params in mods:
+                logger.info(f"Processing modification: {mod_name}, img: {img_obj.path.name}")
 
-            mod_img:Image.Image = Mod().modify_image(img)
+                save_filepath = cached[mod_name]
+                if save_filepath is None or not save_filepath.exists():
+                    if draft_size not in sources:
+                        sources[draft_size] = image.open_image(img_obj.path, draft_size)
+                    source = sources[draft_size]
+                    img:Image.Image = source.copy() if mod.in_place else source
 
-            hash = hash_image(mod_img)
+                    mod_img:Image.Image = mod.modify_image(img)
 
-            save_filepath = (save_path / hash).with_suffix('.png')
+                    hash = image.content_digest(mod_img)
 
-            image.save_image(save_filepath, mod_img)
-            mod_id:int =  self.database.add_modification(mod_name) or self.database.get_mod_id(mod_name)
+                    save_filepath = (save_path / hash).with_suffix(image.SUFFIXES[CONFIG.mod_img_format])
 
-            self.pending += 1
+                    image.save_image(save_filepath, mod_img, CONFIG.mod_img_format)
+                    made.append((mod_name, params, save_filepath))
 
-            if self.pending >= self.batch_size:
-                self.database.commit()
-                self.pending = 0
+                mod_id:int =  self.database.add_modification(mod_name) or self.database.get_mod_id(mod_name)
 
-            id = self.database.add_mod_image(save_filepath, img_obj.id, mod_id) 
-            if id is None:
-                logging.info(f"Already found {save_filepath} in db")
-                continue
+                self.pending += 1
 
+                if self.pending >= self.batch_size:
+                    self.database.commit()
+                    self.pending = 0
 
-            yield ModifiedImage(id, save_filepath, img_obj.id, mod_id) 
-def hash_image(img:Image.Image)->str:
-    hasher = hashlib.blake2b(usedforsecurity=False)
-    hasher.update(img.tobytes())
-    hasher.update(img.mode.encode())
-    hash = hasher.hexdigest()
+                id = self.database.add_mod_image(save_filepath, img_obj.id, mod_id) 
+                if id is None:
+                    logging.info(f"Already found {save_filepath} in db")
+                    continue
 
-    return hash 
 
+                yield ModifiedImage(id, save_filepath, img_obj.id, mod_id) 
+        finally:
+            if self.cache is not None and made:
+                for mod_name, params, save_filepath in made:
+                    self.cache.put(img_obj.path, stat.st_size, stat.st_mtime_ns, mod_name, params, save_filepath)
+                self.cache.commit()
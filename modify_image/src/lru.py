@@ -0,0 +1,55 @@
+import sqlite3
+
+EVICT_FRACTION = 0.01 # Rows added, relative to max_entries, before the table is counted again
+
+class LRUBound:
+    """
+    Keeps a SQLite table at about max_entries rows, deleting the least recently used rows above it. Used by the modification and hash caches.
+    Counting the rows scans the table, so it is only counted once max_entries * EVICT_FRACTION rows were added since the last count,
+    and the table may exceed max_entries by as much in between. The rows added are counted in the file, in the lru_added table,
+    so every instance and every process sharing the file adds to the same count, however few rows each adds.
+    """
+    def __init__(self, conn:sqlite3.Connection, table:str, key:str, used:str, max_entries:int) -> None:
+        """
+        key: Comma separated primary key columns. used: Column holding the last time a row was used
+        """
+        self.conn = conn
+        self.table = table
+        self.key = key
+        self.used = used
+        self.max_entries = max_entries
+        self.evict_every = max(1, int(max_entries * EVICT_FRACTION))
+        self.added = 0 # Not yet counted in the file
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS lru_added (name TEXT PRIMARY KEY, added INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO lru_added (name, added) VALUES (?, 0)", (table,))
+        self.conn.commit()
+
+    def add(self, rows:int = 1):
+        self.added += rows
+
+    def evict(self)->int:
+        """
+        Adds the rows added since the last call to the count in the file and, if enough rows were added since the table was last counted,
+        deletes the least recently used rows above max_entries. Call it in the transaction that added the rows. Returns the amount deleted
+        """
+        if self.added == 0:
+            return 0
+
+        (added,) = self.conn.execute(
+            "UPDATE lru_added SET added = added + ? WHERE name = ? RETURNING added", (self.added, self.table)
+        ).fetchone()
+        self.added = 0
+        if added < self.evict_every:
+            return 0
+        self.conn.execute("UPDATE lru_added SET added = 0 WHERE name = ?", (self.table,))
+
+        (entries,) = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        if entries <= self.max_entries:
+            return 0
+
+        cur = self.conn.execute(
+            f"DELETE FROM {self.table} WHERE ({self.key}) IN (SELECT {self.key} FROM {self.table} ORDER BY {self.used} LIMIT ?)",
+            (entries - self.max_entries,)
+        )
+        return cur.rowcount
@@ -1,6 +1,16 @@
 from abc import ABC, abstractmethod
 from PIL import Image
 class Modification(ABC):
+    in_place:bool = False # True if modify_image changes img itself, then it gets its own copy. Otherwise it gets the source shared by every modification, and must not change it
+    scale_invariant:bool = False # True if modifying a downscaled image gives the downscaled modified image, then it may get a reduced decode
+    version = 1 # Bump when a change alters the modified images, so cached images are not reused
+
+    def params(self)->str:
+        """
+        Identifies the settings of the modification in the modification cache, by default its attributes and version
+        """
+        return ",".join([f"version={self.version}", *(f"{key}={value}" for key, value in sorted(vars(self).items()))])
+
     @abstractmethod
     def modify_image(self, img:Image.Image)->Image.Image:
         pass
@@ -17,11 +27,15 @@ class Modifications:
 
 @Modifications.register(name="base")
 class Base(Modification):
+    scale_invariant = True
+
     def modify_image(self, img: Image.Image) -> Image.Image:
         return img
 
 @Modifications.register(name="rotate_90")
 class Rotate90(Modification):
+    scale_invariant = True
+
     def modify_image(self, img: Image.Image) -> Image.Image:
         return img.transpose(Image.Transpose.ROTATE_90)
 
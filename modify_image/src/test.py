@@ -2,11 +2,14 @@ import unittest
 import tempfile
 from PIL import Image
 from pathlib import Path
-from image import open_image, save_image
+from image import ImageFormat, open_image, save_image
 from unittest.mock import  MagicMock, patch
 from dataclasses import dataclass
 import numpy
+import warnings
+import gc
 import modification
+import cache
 import config as cf
 import app
 
@@ -43,6 +46,55 @@ class TestOpenImage(unittest.TestCase):
         img:Image.Image = open_image(self.img_path)
         self.assertEqual(img.mode, self.img.mode)
 
+    def test_draft_png(self):
+        img:Image.Image = open_image(self.img_path, 10)
+        self.assertEqual(img.size, self.img.size)
+
+    def test_draft_jpeg(self):
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as tmp:
+            self.img.save(tmp.name)
+            img:Image.Image = open_image(Path(tmp.name), 25)
+
+        self.assertEqual(img.size, (25, 25))
+
+    def test_closes_multi_frame_file(self):
+        img = ImageFactory.random_image()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "img.mpo"
+            img.save(path, "MPO", save_all=True, append_images=[img.rotate(90)])
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                opened = open_image(path)
+                self.assertEqual(opened.size, img.size)
+                opened.tobytes()
+                del opened
+                gc.collect()
+
+        self.assertEqual([w for w in caught if issubclass(w.category, ResourceWarning)], [])
+
+class TestSaveImageFormats(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.img:Image.Image = ImageFactory.random_image()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_png(self):
+        for format in (ImageFormat.PNG, ImageFormat.PNG_FAST):
+            path = Path(self.tmp.name) / f"{format.value}.png"
+            save_image(path, self.img, format)
+            self.assertEqual(open_image(path).tobytes(), self.img.tobytes())
+
+    def test_npy(self):
+        path = Path(self.tmp.name) / "img.npy"
+        save_image(path, self.img, ImageFormat.NPY)
+
+        pixels = numpy.load(path, mmap_mode="r")
+        self.assertEqual(pixels.shape, (100, 100, 3))
+        self.assertEqual(pixels.tobytes(), self.img.tobytes())
+
 class TestSaveImage(unittest.TestCase):
     def setUp(self) -> None:
         self.tmp = tempfile.NamedTemporaryFile(suffix=".png")
@@ -70,6 +122,62 @@ class TestImageModifications(unittest.TestCase):
         img = modification.Base().modify_image(self.img)
         self.assertEqual(img, self.img)
 
+    def test_not_in_place(self):
+        """
+        Modifications that are not in_place share the source image, so they must not change it
+        """
+        img_bytes = self.img.tobytes()
+        for name, Mod in modification.Modifications.modifications.items():
+            if not Mod.in_place:
+                Mod().modify_image(self.img)
+                self.assertEqual(self.img.tobytes(), img_bytes, name)
+
+class TestModificationCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.ModificationCache(Path(self.tmp.name) / "modifications.sqlite3", max_entries=2)
+        self.source = Path("/images/source.png")
+
+    def tearDown(self) -> None:
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def test_get(self):
+        self.cache.put(self.source, 100, 1, "rotate_90", "version=1", Path("/mod/a.png"))
+
+        self.assertEqual(self.cache.get(self.source, 100, 1, "rotate_90", "version=1"), Path("/mod/a.png"))
+        self.assertIsNone(self.cache.get(self.source, 100, 1, "base", "version=1"))
+        self.assertIsNone(self.cache.get(self.source, 100, 1, "rotate_90", "version=2"))
+
+    def test_changed_source(self):
+        self.cache.put(self.source, 100, 1, "base", "version=1", Path("/mod/a.png"))
+
+        self.assertIsNone(self.cache.get(self.source, 100, 2, "base", "version=1"))
+        self.assertIsNone(self.cache.get(self.source, 101, 1, "base", "version=1"))
+
+    def test_evicts_least_recently_used(self):
+        for name in ("a", "b"):
+            self.cache.put(Path(name), 1, 1, "base", "", Path(f"/mod/{name}.png"))
+        self.cache.get(Path("a"), 1, 1, "base", "")
+        self.cache.put(Path("c"), 1, 1, "base", "", Path("/mod/c.png"))
+        self.cache.commit()
+
+        self.assertIsNone(self.cache.get(Path("b"), 1, 1, "base", ""))
+        self.assertIsNotNone(self.cache.get(Path("a"), 1, 1, "base", ""))
+
+    def test_evicts_over_instances(self):
+        """
+        Every request of the modifier opens the cache again and adds a few images, the count is kept in the file
+        """
+        path = Path(self.tmp.name) / "shared.sqlite3"
+        for i in range(200):
+            with cache.ModificationCache(path, max_entries=300) as shared: # Counted every 3 added images
+                for name in ("base", "rotate_90"):
+                    shared.put(Path(f"{i}.png"), 1, 1, name, "", Path(f"/mod/{i}_{name}.png"))
+
+        with cache.ModificationCache(path, max_entries=300) as shared:
+            self.assertLess(shared.conn.execute("SELECT COUNT(*) FROM modified_images").fetchone()[0], 300 + shared.bound.evict_every)
+
 class TestConfigFromEnv(unittest.TestCase):
     def setUp(self) -> None:
         pass
@@ -101,7 +209,11 @@ class TestConfigFromEnv(unittest.TestCase):
                                         cf.DEFAULT_POSTGRESQL_HOST,
                                         cf.DEFAULT_POSTGRESQL_DB,
                                         cf.DEFAULT_POSTGRESQL_USER,
-                                        cf.DEFAULT_POSTGRESQL_PASSWORD)
+                                        cf.DEFAULT_POSTGRESQL_PASSWORD,
+                                        cf.DEFAULT_MOD_IMG_FORMAT,
+                                        cf.DEFAULT_MOD_DRAFT_SIZE,
+                                        cf.DEFAULT_MOD_CACHE_PATH,
+                                        cf.DEFAULT_MOD_CACHE_SIZE)
             config =cf.Config.from_env()
 
         self.assertEqual(config,  expected_config)
@@ -11,6 +11,7 @@ DEFAULT_POSTGRESQL_HOST = "db"
 DEFAULT_POSTGRESQL_DB = "mydb"
 DEFAULT_POSTGRESQL_USER = "user"
 DEFAULT_POSTGRESQL_PASSWORD = "password"
+DEFAULT_HASH_BATCH_SIZE = 16 # Most modified images sent to the hasher at once, it hashes them together
 
 @dataclass
 class Config:
@@ -19,6 +20,8 @@ class Config:
     hasher_url: str
     matcher_url: str
 
+    hash_batch_size: int
+
     modified_img_path: Path
     input_img_path: Path
 
@@ -36,6 +39,8 @@ class Config:
             hasher_url=os.getenv("HASHER_URL", "http://hasher:8000"),
             matcher_url=os.getenv("MATCHER_URL", "http://matcher:8000"),
 
+            hash_batch_size=int(os.getenv("HASH_BATCH_SIZE", DEFAULT_HASH_BATCH_SIZE)),
+
             modified_img_path=Path(os.getenv("MOD_IMG_PATH", DEFAULT_MOD_IMG_PATH)),
             input_img_path=Path(os.getenv("INPUT_IMG_PATH", DEFAULT_INPUT_IMG_PATH)),
 
@@ -90,6 +90,26 @@ class Component:
             async for result in self.start_iter(path, json):
                 await out_queue.put(result)
 
+    async def start_batch_io_queue(self, in_queue:asyncio.Queue[ComponentResponse], out_queue:asyncio.Queue, path:str, json_func:Callable[[list[ComponentResponse]], dict], batch_size:int):
+        """
+        Like start_io_queue, but sends everything waiting in the input queue at once, up to batch_size items.
+        It does not wait for a batch to fill, so a slow producer still gets single items through.
+
+        json_func: A function that returns json as payload. MUST take a list of the json/dict objects as arg and return json/dict
+        """
+
+        logging.info(f"Started {self.url}")
+
+        while True:
+            batch:list[ComponentResponse] = [await in_queue.get()]
+            while len(batch) < batch_size and not in_queue.empty():
+                batch.append(in_queue.get_nowait())
+            logging.info(f"{self.url} component got {len(batch)} items from queue")
+            json:dict = json_func(batch)
+
+            async for result in self.start_iter(path, json):
+                await out_queue.put(result)
+
     async def start_iter(self, path:str, json:dict|None = None)->AsyncGenerator[ComponentResponse]:
         """
         Checks health of the component. If it succeeds it starts yielding the responses from the component given by `response_type`
@@ -147,6 +167,12 @@ class Component:
 
             tries = 0
 
+            if resp.status_code == 503:
+                retry_after = float(resp.headers.get("Retry-After", interval))
+                logging.info(f"{self.url} is busy. Retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+                continue
+
             logging.info(f"Got {resp} from {self.url}")
 
             result = resp.json()
@@ -262,19 +288,62 @@ async def run_pipeline():
         """
         return {"image": comp.model_dump(),"limit": 10}
 
-    def limit_json_hash(comp:ComponentResponse)->dict:
+    def batch_json_hash(comps:list[ComponentResponse])->dict:
         """
-        Returns the component in json along with limit
+        Returns the components in json along with the batch size the hasher commits at. The hasher returns every hash of the images
         """
-        return {"modified_image": comp.model_dump(),"limit": 10}
+        return {"modified_images": [comp.model_dump() for comp in comps], "batch_size": 10}
 
     tasks = [
          loader.start_output_queue(loader_q, path="/load/next",json={"limit":10}),
          modifier.start_io_queue(loader_q, mod_q, path="/modify/next",json_func=limit_json_mod),
-         hasher.start_io_queue(mod_q, hash_q, path="/hash/next",json_func=limit_json_hash),
+         hasher.start_batch_io_queue(mod_q, hash_q, path="/hash/batch",json_func=batch_json_hash, batch_size=CONFIG.hash_batch_size),
     ]
 
 
+    coros = list(map(asyncio.create_task, tasks))
+
+    try:
+        await asyncio.gather(*coros)
+    except asyncio.CancelledError:
+        for coro in coros:
+            coro.cancel()
+        await asyncio.gather(*coros, return_exceptions=True)
+
+async def run_fused_pipeline(persist:bool = False):
+    """
+    Loads images and lets the hasher modify and hash them in one step, see /hash/fused of the hasher. The modifier is not used.
+    persist: Also save the modified images, like the modifier does
+    """
+    loader = Component(CONFIG.loader_url, health_path="/load/health", response_type=LoadResponse, response_key="images")
+    hasher = Component(CONFIG.hasher_url, health_path="/hash/health", response_type=HashResponse, response_key="hashes")
+
+    loader_q: asyncio.Queue[ComponentResponse]= asyncio.Queue(maxsize=100)
+    hash_q: asyncio.Queue[ComponentResponse] = asyncio.Queue(maxsize=300)
+
+    def batch_json_fused(comp:ComponentResponse)->dict:
+        """
+        Returns the component in json along with the batch size the hasher commits at. The hasher returns every hash of the image
+        """
+        return {"image": comp.model_dump(), "batch_size": 10, "persist": persist}
+
+    async def count_hashes():
+        """
+        Empties the hash queue, so the hasher is not blocked by it
+        """
+        hashes = 0
+        while True:
+            await hash_q.get()
+            hashes += 1
+            if hashes % 100 == 0:
+                logging.info(f"Fused pipeline made {hashes} hashes")
+
+    tasks = [
+         loader.start_output_queue(loader_q, path="/load/next",json={"limit":10}),
+         hasher.start_io_queue(loader_q, hash_q, path="/hash/fused",json_func=batch_json_fused),
+         count_hashes(),
+    ]
+
     coros = list(map(asyncio.create_task, tasks))
 
     try:
@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from .lib import run_pipeline , run_matching
+from .lib import run_pipeline , run_fused_pipeline, run_matching
 import asyncio
 
 router = APIRouter()
@@ -12,6 +12,14 @@ async def start_all_components():
     asyncio.create_task(run_pipeline())
     return {"state": "started"}
 
+@router.post("/admin/start/fused")
+async def start_fused(persist:bool = False):
+    """
+    starts load images and the fused modify and hash stage of the hasher
+    """
+    asyncio.create_task(run_fused_pipeline(persist))
+    return {"state": "started"}
+
 @router.post("/admin/start/match")
 async def start_matching():
     asyncio.create_task(run_matching())